@@ -50,11 +50,35 @@ Help make the internet a kinder place, one comment at a time. Your contribution
 Thank you!
 """
 
-from chill import improvement_loop
+from html import escape
+from chill import improvement_loop_iter
+from utils import warmup
+
+# Load models and compile grammars before serving, rather than on the first request
+warmup()
+
+def format_progress(edit, note):
+    return f"""
+    <div>
+        <h4>Edited text so far:</h4>
+        <p>{escape(edit)}</p>
+        <p><i>{escape(note)}</i></p>
+    </div>
+    """
+
 
 def chill_out(text):
+    # Streams progress to the browser: the first edit as it's written, then the best edit after each iteration
     print("Got this input:", text)
-    result: dict = improvement_loop(text)
+    for update in improvement_loop_iter(text):
+        if update["event"] == "partial":
+            yield format_progress(update["edit"], f"Writing iteration {update['iteration']}...")
+        elif update["event"] == "iteration":
+            suggestion = update["suggestion"]
+            note = f"Iteration {update['iteration']} scored {suggestion['overall_score']:.0%} after {update['time_used']:.1f} seconds, still improving..."
+            yield format_progress(suggestion["edit"], note)
+        else:
+            result: dict = update["result"]
     print("Got this result:", result)
 
     formatted_output = f"""
@@ -73,7 +97,7 @@ def chill_out(text):
         </ul>
     </div>
     """
-    return formatted_output
+    yield formatted_output
 
 demo = gr.Interface(
     fn=chill_out, 
@@ -86,4 +110,6 @@ demo = gr.Interface(
     allow_flagging="never",
 )
 
+# Generator functions need the queue to stream their updates
+demo.queue()
 demo.launch(max_threads=1, share=True)
\ No newline at end of file
@@ -0,0 +1,187 @@
+from argparse import ArgumentParser
+import asyncio
+import json
+import subprocess
+from datetime import datetime
+from os import environ as env
+from time import time
+from stats import percentile
+from stub_llm_server import StubConfig, start_stub_server
+
+# Offline benchmarks of improvement_loop against the stub LLM server, no model, API key or network needed.
+# Runs every combination of worker, concurrency and text size, and appends the results to BENCHMARK_RESULTS_PATH,
+# then compares each result with the last stored run of the same combination, to spot regressions.
+# E.g: python3 benchmark.py --workers http,mistral --concurrency 1,8 --sizes short,long --texts 16
+# The http worker builds grammars with llama_cpp, so it needs llama-cpp-python installed, though no model.
+
+BENCHMARK_RESULTS_PATH = env.get("BENCHMARK_RESULTS_PATH", "benchmark_results.jsonl")
+REGRESSION_THRESHOLD = 0.1  # Fractional slowdown reported as a regression
+
+SAMPLE_SENTENCES = [
+    "You guys are so slow, we will never ship it!",
+    "Your idea of a balanced diet is a biscuit in each hand.",
+    "Stop chasing dreams instead, life is not a Hollywood movie.",
+    "It is always some external thing that happened to you, never your own fault.",
+]
+TEXT_SIZES = {"short": 1, "medium": 6, "long": 24}  # Sentences per text
+
+
+def sample_text(size, index):
+    sentences = [SAMPLE_SENTENCES[(index + offset) % len(SAMPLE_SENTENCES)] for offset in range(TEXT_SIZES[size])]
+    return " ".join(sentences)
+
+
+def configure_workers(stub_url):
+    # Set before utils is imported, as it reads its worker configuration at import time
+    env["LLM_HTTP_URLS"] = f"{stub_url}/v1/chat/completions"
+    env["LLM_HTTP_HEALTH_INTERVAL"] = "0"
+    env["MISTRAL_API_URL"] = f"{stub_url}/v1/chat/completions"
+    env["MISTRAL_API_KEY"] = env.get("MISTRAL_API_KEY", "stub")
+    env["ANTHROPIC_API_URL"] = f"{stub_url}/v1/messages"
+    env["ANTHROPIC_API_KEY"] = env.get("ANTHROPIC_API_KEY", "stub")
+    env["RUNPOD_API_URL"] = stub_url
+    env["RUNPOD_ENDPOINT_ID"] = env.get("RUNPOD_ENDPOINT_ID", "stub")
+    env["RUNPOD_API_KEY"] = env.get("RUNPOD_API_KEY", "stub")
+    # The stub has no rate limits of its own, unlike the real Mistral API
+    env.setdefault("MISTRAL_REQUESTS_PER_SECOND", "0")
+    # Keeps the input and output log local rather than posting it to SAVE_URL
+    env.setdefault("SKIP_NETWORK", "true")
+
+
+async def run_case(worker, concurrency, size, text_count, max_iterations):
+    import utils
+    from chill import improvement_loop_async
+
+    utils.LLM_WORKER = worker
+    await utils.get_worker_async(worker)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = []
+    llm_calls = 0
+
+    async def improve(index):
+        nonlocal llm_calls
+        async with semaphore:
+            start_time = time()
+            try:
+                result = await improvement_loop_async(
+                    sample_text(size, index), max_iterations=max_iterations, verbose=False, use_cache=False,
+                )
+                llm_calls += len(result["timings"]["calls"])
+                latencies.append(time() - start_time)
+            except Exception as e:
+                errors.append(repr(e))
+
+    start_time = time()
+    await asyncio.gather(*[improve(index) for index in range(text_count)])
+    wall_seconds = time() - start_time
+    return {
+        "texts": text_count,
+        "errors": len(errors),
+        "wall_seconds": round(wall_seconds, 3),
+        "texts_per_second": round(len(latencies) / wall_seconds, 3),
+        "llm_calls_per_second": round(llm_calls / wall_seconds, 3),
+        "p50_seconds": round(percentile(latencies, 0.5), 3) if latencies else None,
+        "p95_seconds": round(percentile(latencies, 0.95), 3) if latencies else None,
+        "max_seconds": round(max(latencies), 3) if latencies else None,
+        "first_error": errors[0] if errors else None,
+    }
+
+
+def case_key(case):
+    return json.dumps({key: case[key] for key in ["worker", "concurrency", "size", "max_iterations", "stub"]}, sort_keys=True)
+
+
+def load_previous_results(path=BENCHMARK_RESULTS_PATH):
+    previous = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    case = json.loads(line)
+                    previous[case_key(case)] = case  # Later runs replace earlier ones
+    except FileNotFoundError:
+        pass
+    return previous
+
+
+def compare(case, previous_case):
+    # Returns a short comparison with the last run of the same case, flagging slowdowns
+    if previous_case is None or not previous_case["result"]["p50_seconds"] or not case["result"]["p50_seconds"]:
+        return "no previous run"
+    change = case["result"]["p50_seconds"] / previous_case["result"]["p50_seconds"] - 1
+    throughput_change = case["result"]["texts_per_second"] / max(previous_case["result"]["texts_per_second"], 1e-9) - 1
+    flag = " REGRESSION" if change > REGRESSION_THRESHOLD else ""
+    return f"p50 {change:+.0%}, throughput {throughput_change:+.0%} vs {previous_case['commit']} at {previous_case['timestamp']}{flag}"
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def run_benchmarks(workers, concurrency_levels, sizes, text_count, max_iterations, stub_config, save=True):
+    """Runs each combination against an in process stub server, returns the cases, and appends them to the results file."""
+    server = start_stub_server(stub_config)
+    configure_workers(f"http://127.0.0.1:{server.server_port}")
+    from utils import run_sync
+
+    stub = {
+        "latency": stub_config.latency,
+        "tokens_per_second": stub_config.tokens_per_second,
+        "error_rate": stub_config.error_rate,
+        "rate_limit_rate": stub_config.rate_limit_rate,
+    }
+    previous = load_previous_results()
+    cases = []
+    commit = git_commit()
+    for worker in workers:
+        for concurrency in concurrency_levels:
+            for size in sizes:
+                result = run_sync(run_case(worker, concurrency, size, text_count, max_iterations))
+                case = {
+                    "timestamp": datetime.utcnow().isoformat(),
+                    "commit": commit,
+                    "worker": worker,
+                    "concurrency": concurrency,
+                    "size": size,
+                    "max_iterations": max_iterations,
+                    "stub": stub,
+                    "result": result,
+                }
+                print(f"{worker} concurrency={concurrency} size={size}: {json.dumps(result)}")
+                print(f"  {compare(case, previous.get(case_key(case)))}")
+                cases.append(case)
+                if save:
+                    with open(BENCHMARK_RESULTS_PATH, "a") as f:
+                        f.write(json.dumps(case) + "\n")
+    server.shutdown()
+    return cases
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark improvement_loop against a local stub LLM server.")
+    parser.add_argument("--workers", default="http,mistral,anthropic,runpod", help="Comma separated worker names")
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma separated numbers of texts improved at once")
+    parser.add_argument("--sizes", default="short,medium,long", help=f"Comma separated text sizes from: {', '.join(TEXT_SIZES)}")
+    parser.add_argument("--texts", type=int, default=16, help="Texts improved per combination")
+    parser.add_argument("--max-iterations", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.1, help="Stub seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=100.0, help="Stub generation speed")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of stub requests answered with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of stub requests answered with a 429")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-save", action="store_true", help="Don't append the results to the results file")
+    args = parser.parse_args()
+
+    run_benchmarks(
+        workers=args.workers.split(","),
+        concurrency_levels=[int(level) for level in args.concurrency.split(",")],
+        sizes=args.sizes.split(","),
+        text_count=args.texts,
+        max_iterations=args.max_iterations,
+        stub_config=StubConfig(args.latency, args.tokens_per_second, args.error_rate, args.rate_limit_rate, args.seed),
+        save=not args.no_save,
+    )
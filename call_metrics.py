@@ -0,0 +1,240 @@
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import environ as env
+from threading import Lock, Thread
+from time import time
+
+# Timing for each LLM call made through query_ai_prompt: time to first token, output tokens, tokens/s,
+# time spent queued (rate limiters and the in memory scheduler), retries, hedging and the worker used.
+# Workers report progress to the call timer of the current context, so nothing needs passing down to them.
+# Callers collect the timings of their calls with collect_calls(), and totals are kept for a
+# Prometheus / OpenMetrics text endpoint, served on METRICS_PORT when it's set.
+
+METRICS_PORT = int(env.get("METRICS_PORT", 0))
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80]
+
+current_call = ContextVar("current_call", default=None)
+collected_calls = ContextVar("collected_calls", default=None)
+
+
+class CallTimer:
+    def __init__(self, stage, model_class_name, prompt_chars):
+        self.stage = stage
+        self.model_class = model_class_name
+        self.prompt_chars = prompt_chars
+        self.worker = None
+        self.cached = False
+        self.retries = 0
+        self.hedged = False
+        self.cancelled = False
+        self.queue_seconds = 0.0
+        self.output_tokens = 0
+        self.started_at = time()
+        self.first_token_at = None
+        self.finished_at = None
+
+    def to_dict(self):
+        total_seconds = (self.finished_at or time()) - self.started_at
+        ttft_seconds = self.first_token_at - self.started_at if self.first_token_at else None
+        generating_seconds = (self.finished_at or time()) - self.first_token_at if self.first_token_at else 0.0
+        return {
+            "stage": self.stage,
+            "worker": self.worker,
+            "model_class": self.model_class,
+            "prompt_chars": self.prompt_chars,
+            "cached": self.cached,
+            "retries": self.retries,
+            "hedged": self.hedged,
+            "cancelled": self.cancelled,
+            "queue_seconds": round(self.queue_seconds, 4),
+            "ttft_seconds": round(ttft_seconds, 4) if ttft_seconds is not None else None,
+            "total_seconds": round(total_seconds, 4),
+            "output_tokens": self.output_tokens,
+            "tokens_per_second": round(self.output_tokens / generating_seconds, 2) if self.output_tokens and generating_seconds > 0 else None,
+        }
+
+
+@contextmanager
+def time_call(stage, model_class_name, prompt):
+    """Times one query_ai_prompt call, workers it calls report to it through the context."""
+    timer = CallTimer(stage, model_class_name, len(prompt))
+    token = current_call.set(timer)
+    try:
+        yield timer
+    except asyncio.CancelledError:
+        # E.g: cut off at its deadline
+        timer.cancelled = True
+        raise
+    finally:
+        current_call.reset(token)
+        timer.finished_at = time()
+        registry.observe(timer)
+        calls = collected_calls.get()
+        if calls is not None:
+            calls.append(timer.to_dict())
+
+
+@contextmanager
+def collect_calls():
+    """Use as "with collect_calls() as calls:", calls is a list that gets the timing dict of each call made inside."""
+    calls = []
+    token = collected_calls.set(calls)
+    try:
+        yield calls
+    finally:
+        collected_calls.reset(token)
+
+
+def record_tokens(count=1):
+    # Streaming workers call this per token, others once with the usage the API reports
+    timer = current_call.get()
+    if timer is not None:
+        if timer.first_token_at is None:
+            timer.first_token_at = time()
+        timer.output_tokens += count
+
+
+def record_queue_wait(seconds):
+    timer = current_call.get()
+    if timer is not None:
+        timer.queue_seconds += seconds
+
+
+def record_retry():
+    timer = current_call.get()
+    if timer is not None:
+        timer.retries += 1
+
+
+def record_hedge():
+    timer = current_call.get()
+    if timer is not None:
+        timer.hedged = True
+
+
+def stage_breakdown(calls):
+    """Sums a list of call timing dicts by stage."""
+    stages = {}
+    for call in calls:
+        stage = stages.setdefault(call["stage"], {"calls": 0, "seconds": 0.0, "max_seconds": 0.0, "output_tokens": 0, "retries": 0})
+        stage["calls"] += 1
+        stage["seconds"] = round(stage["seconds"] + call["total_seconds"], 4)
+        stage["max_seconds"] = max(stage["max_seconds"], call["total_seconds"])
+        stage["output_tokens"] += call["output_tokens"]
+        stage["retries"] += call["retries"]
+    return stages
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+
+def labels_text(labels):
+    return ",".join(f'{key}="{value}"' for key, value in labels)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = {}  # (worker, stage, cached) -> count
+        self.retries = {}  # worker -> count
+        self.hedges = {}  # worker -> count
+        self.output_tokens = {}  # worker -> count
+        self.latency = {}  # worker -> Histogram of call seconds
+        self.ttft = {}  # worker -> Histogram of time to first token
+        self.queue = {}  # worker -> Histogram of queued seconds
+
+    def observe(self, timer):
+        worker = timer.worker or "unknown"
+        stats = timer.to_dict()
+        with self.lock:
+            key = (worker, timer.stage, str(timer.cached).lower())
+            self.calls[key] = self.calls.get(key, 0) + 1
+            self.retries[worker] = self.retries.get(worker, 0) + timer.retries
+            self.hedges[worker] = self.hedges.get(worker, 0) + int(timer.hedged)
+            self.output_tokens[worker] = self.output_tokens.get(worker, 0) + timer.output_tokens
+            if timer.cached:
+                return
+            self.latency.setdefault(worker, Histogram(LATENCY_BUCKETS)).observe(stats["total_seconds"])
+            self.queue.setdefault(worker, Histogram(LATENCY_BUCKETS)).observe(stats["queue_seconds"])
+            if stats["ttft_seconds"] is not None:
+                self.ttft.setdefault(worker, Histogram(LATENCY_BUCKETS)).observe(stats["ttft_seconds"])
+
+    def render(self) -> str:
+        """Returns all metrics in the OpenMetrics text format."""
+        lines = []
+
+        def counter(name, help_text, values):
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"# HELP {name} {help_text}")
+            for labels, value in values:
+                lines.append(f"{name}_total{{{labels_text(labels)}}} {value}")
+
+        def histogram(name, help_text, histograms):
+            lines.append(f"# TYPE {name} histogram")
+            lines.append(f"# HELP {name} {help_text}")
+            for worker, histogram_values in histograms.items():
+                for bound, count in zip(histogram_values.buckets, histogram_values.counts):
+                    lines.append(f'{name}_bucket{{worker="{worker}",le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{worker="{worker}",le="+Inf"}} {histogram_values.count}')
+                lines.append(f'{name}_count{{worker="{worker}"}} {histogram_values.count}')
+                lines.append(f'{name}_sum{{worker="{worker}"}} {histogram_values.sum}')
+
+        with self.lock:
+            counter("chill_llm_calls", "LLM calls made through query_ai_prompt.",
+                    [((("worker", w), ("stage", s), ("cached", c)), n) for (w, s, c), n in self.calls.items()])
+            counter("chill_llm_retries", "LLM call retries.", [((("worker", w),), n) for w, n in self.retries.items()])
+            counter("chill_llm_hedges", "LLM calls hedged with a second worker.", [((("worker", w),), n) for w, n in self.hedges.items()])
+            counter("chill_llm_output_tokens", "Tokens generated.", [((("worker", w),), n) for w, n in self.output_tokens.items()])
+            histogram("chill_llm_call_seconds", "Total LLM call time, excluding cache hits.", self.latency)
+            histogram("chill_llm_ttft_seconds", "Time to first token.", self.ttft)
+            histogram("chill_llm_queue_seconds", "Time spent waiting in rate limiters and schedulers.", self.queue)
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/openmetrics-text; version=1.0.0; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+_metrics_server = None
+
+
+def start_metrics_server(port=METRICS_PORT):
+    """Serves /metrics on a background thread, if a port is set and it isn't running already."""
+    global _metrics_server
+    if not port or _metrics_server is not None:
+        return _metrics_server
+    _metrics_server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    Thread(target=_metrics_server.serve_forever, daemon=True, name="metrics-server").start()
+    print(f"Serving metrics on port {port} at /metrics")
+    return _metrics_server
@@ -1,20 +1,33 @@
 # chill.py
 from argparse import ArgumentParser
+import asyncio
 import json
+import sys
+from queue import Queue
+from contextlib import redirect_stdout
+from os import environ as env
+from threading import Lock
 from time import time
 from uuid import uuid4
 from data import log_to_jsonl
 from datetime import datetime
-from utils import calculate_overall_score, query_ai_prompt
+from utils import TEMPERATURE, DeadlineExceeded, calculate_overall_score, get_background_loop, query_ai_prompt_async, run_sync, sampling_at
+from streaming_json import listen_partial_output
+from call_metrics import collect_calls, stage_breakdown
+from llm_scheduler import scheduling_priority
+from toxicity import CALM_THRESHOLD, toxicity_scores_async
+from local_judge import LOCAL_JUDGE, local_judgements_async, spicy_from_toxicity
 from promptObjects import (
     improve_prompt,
     critique_prompt,
     faith_scorer_prompt,
     spicy_scorer_prompt,
+    judge_prompt,
     ImprovedText,
     Critique,
     FaithfulnessScore,
     SpicyScore,
+    Judgement,
 )
 
 # This script uses the large language model to improve a text, it depends on a llama_cpp server being setup with a model loaded.
@@ -43,6 +56,25 @@ Outputs something like this:
 """
 
 
+# Opt-in: critique and score with one combined "judge" request instead of three separate ones:
+FUSED_JUDGE = env.get("FUSED_JUDGE", "false").lower() == "true"
+# In segmenting mode, sentences the local toxicity model scores at or above this are improved, the rest are kept
+SEGMENT_TOXICITY_THRESHOLD = float(env.get("SEGMENT_TOXICITY_THRESHOLD", 0.5))
+# Texts improved at once by the batch API and CLI, their LLM calls are still subject to each worker's rate limits
+BATCH_CONCURRENCY = int(env.get("BATCH_CONCURRENCY", 8))
+# Opt-in: judge all of an improve call's variants and keep the best, to reach good_score in fewer iterations
+CANDIDATE_TOURNAMENT = env.get("CANDIDATE_TOURNAMENT", "false").lower() == "true"
+CANDIDATE_VARIANTS = ["hybrid", "worst_fix", "nvc", "constructive"]  # Ties go to the first
+# Speculative sampling: improve requests sent at once each iteration, at different temperatures, all judged.
+# Trades extra, parallel, tokens for reaching a good score in fewer sequential rounds. 1 turns it off.
+SPECULATIVE_SAMPLES = int(env.get("SPECULATIVE_SAMPLES", 1))
+# Repeats are dropped, a round sends at most one sample per temperature
+SAMPLE_TEMPERATURES = list(dict.fromkeys(float(t) for t in env.get("SAMPLE_TEMPERATURES", "").split(",") if t.strip()))
+SAMPLE_TEMPERATURE_MAX = float(env.get("SAMPLE_TEMPERATURE_MAX", 1.0))
+# Cap on LLM calls per improvement_loop, fewer samples are sent once it's near, 0 for no cap
+MAX_LLM_CALLS = int(env.get("MAX_LLM_CALLS", 0))
+KEEP_SUGGESTIONS = int(env.get("KEEP_SUGGESTIONS", 2))  # Top suggestions kept, and shown to the next improve prompt
+
 
 class ImprovementContext:
     def __init__(self, original_text=None):
@@ -52,33 +84,74 @@ class ImprovementContext:
         self.start_time = time()
         self.original_text = original_text
         self.improvement_result  = dict()
+        self.request_count_lock = Lock()
+        self.fused_judge = FUSED_JUDGE
+        self.local_judge = LOCAL_JUDGE
+        self.tournament = CANDIDATE_TOURNAMENT
+        self.keep_suggestions = KEEP_SUGGESTIONS
+        self.use_cache = True
+        self.deadline = None  # time() each LLM call must finish by, None waits for it
+        self.iteration = 0  # Iterations finished
+        self.on_update = None  # Called with progress updates, see improvement_loop_iter_async
 
-def query_ai_prompt_with_count(prompt, replacements, model_class, context):
-    context.request_count += 1
-    return query_ai_prompt(prompt, replacements, model_class)
+async def query_ai_prompt_with_count(prompt, replacements, model_class, context, stage, use_cache=True):
+    # Judge requests run concurrently, and contexts may be shared across threads, so the count is guarded:
+    with context.request_count_lock:
+        context.request_count += 1
+    return await query_ai_prompt_async(
+        prompt, replacements, model_class, use_cache=context.use_cache and use_cache, stage=stage, deadline=context.deadline
+    )
 
 
 
 
-def improve_text_attempt(context):
+async def improve_text_attempt_async(context, use_cache=True):
     replacements = {
         "original_text": json.dumps(context.original_text),
         "previous_suggestions": json.dumps(context.suggestions, indent=2),
     }
-    return query_ai_prompt_with_count(improve_prompt, replacements, ImprovedText, context)
+    return await query_ai_prompt_with_count(improve_prompt, replacements, ImprovedText, context, "improve", use_cache)
+
 
+def improve_text_attempt(context):
+    return run_sync(improve_text_attempt_async(context))
 
-def critique_text(context):
-    replacements = {"original_text": context.original_text, "last_edit": context.last_edit}
 
-    # Query the AI for each of the new prompts separately
+async def fused_judge_text(context, replacements):
+    # One request returns the critique and both scores, if the output doesn't validate we return None
+    try:
+        judge_resp = await query_ai_prompt_with_count(judge_prompt, replacements, Judgement, context, "judge")
+        return Judgement.model_validate(judge_resp).model_dump()
+    except DeadlineExceeded:
+        raise  # Out of time, the separate prompts would be too
+    except Exception as e:
+        print(f"Fused judge failed, falling back to separate prompts: {e}")
+        return None
 
-    critique_resp = query_ai_prompt_with_count(critique_prompt, replacements, Critique, context)
-    faithfulness_resp = query_ai_prompt_with_count(
-        faith_scorer_prompt, replacements, FaithfulnessScore, context
-    )
-    spiciness_resp = query_ai_prompt_with_count(
-        spicy_scorer_prompt, replacements, SpicyScore, context
+
+async def critique_text_async(context, edit=None):
+    # Judges edit, by default the context's last edit
+    edit = edit or context.last_edit
+    replacements = {"original_text": context.original_text, "last_edit": edit}
+
+    if context.local_judge:
+        # Only the critique needs the LLM, the scores come from local models meanwhile
+        critique_resp, judgements = await asyncio.gather(
+            query_ai_prompt_with_count(critique_prompt, replacements, Critique, context, "critique"),
+            local_judgements_async(context.original_text, [edit]),
+        )
+        return {"critique": critique_resp["critique"], **judgements[0]}
+
+    if context.fused_judge:
+        combined_resp = await fused_judge_text(context, replacements)
+        if combined_resp is not None:
+            return combined_resp
+
+    # Query the AI for each of the new prompts separately, they are independent so we send them concurrently
+    critique_resp, faithfulness_resp, spiciness_resp = await asyncio.gather(
+        query_ai_prompt_with_count(critique_prompt, replacements, Critique, context, "critique"),
+        query_ai_prompt_with_count(faith_scorer_prompt, replacements, FaithfulnessScore, context, "faith"),
+        query_ai_prompt_with_count(spicy_scorer_prompt, replacements, SpicyScore, context, "spicy"),
     )
 
     # Combine the results from the three queries into a single dictionary
@@ -91,6 +164,93 @@ def critique_text(context):
     return combined_resp
 
 
+def critique_text(context, edit=None):
+    return run_sync(critique_text_async(context, edit))
+
+
+def judged_score(judgement):
+    return calculate_overall_score(judgement["faithfulness_score"], judgement["spicy_score"])
+
+
+async def judge_candidates_async(context, improvement_result):
+    """
+    Candidate tournament: judges every variant from an improve call, rather than only "hybrid",
+    and returns the best edit, with its critique dict, which has all the variants' scores.
+    """
+    variants = {}
+    for name in CANDIDATE_VARIANTS:
+        edit = improvement_result.get(name)
+        if edit and edit not in variants.values():
+            variants[name] = edit
+    names, edits = list(variants), list(variants.values())
+
+    if context.local_judge:
+        # One batched local scoring pass, then only the winner's critique needs the LLM
+        judgements = await local_judgements_async(context.original_text, edits)
+        scores = [judged_score(judgement) for judgement in judgements]
+        best = scores.index(max(scores))
+        replacements = {"original_text": context.original_text, "last_edit": edits[best]}
+        critique_resp = await query_ai_prompt_with_count(critique_prompt, replacements, Critique, context, "critique")
+        critique_dict = {"critique": critique_resp["critique"], **judgements[best]}
+    else:
+        judgements = await asyncio.gather(*[critique_text_async(context, edit) for edit in edits])
+        scores = [judged_score(judgement) for judgement in judgements]
+        best = scores.index(max(scores))
+        critique_dict = judgements[best]
+
+    critique_dict["variant"] = names[best]
+    critique_dict["variant_scores"] = {name: round(score, 2) for name, score in zip(names, scores)}
+    return edits[best], critique_dict
+
+
+def partial_edit_listener(context):
+    # Passes the hybrid edit on as it streams in, from workers that stream their output
+    def listener(fields):
+        if isinstance(fields.get("hybrid"), str):
+            context.on_update({"event": "partial", "iteration": context.iteration + 1, "edit": fields["hybrid"]})
+    return listener
+
+
+async def improve_sample_async(context, temperature=None, stream_edit=False):
+    # One attempt: an improve call, sampled at temperature if set, and the judging of its edit
+    listener = partial_edit_listener(context) if stream_edit and context.on_update else None
+    with sampling_at(temperature), listen_partial_output(listener):
+        # A sample is meant to be a fresh draw, a cached one would repeat the last run's edit
+        improvement_result = await improve_text_attempt_async(context, use_cache=temperature is None)
+    if context.tournament:
+        edit, critique_dict = await judge_candidates_async(context, improvement_result)
+    else:
+        edit = improvement_result["hybrid"]
+        critique_dict = await critique_text_async(context, edit)
+    return improvement_result, edit, critique_dict
+
+
+def sample_temperatures(samples):
+    # Spread from the usual temperature up to SAMPLE_TEMPERATURE_MAX, or as set in SAMPLE_TEMPERATURES.
+    # Temperatures are distinct, so fewer samples are sent than asked for if there aren't enough of them,
+    # two samples at one temperature would be near duplicates, or one coalesced call.
+    if samples == 1:
+        return [None]
+    if SAMPLE_TEMPERATURES:
+        return SAMPLE_TEMPERATURES[:samples]
+    step = (SAMPLE_TEMPERATURE_MAX - TEMPERATURE) / (samples - 1)
+    return list(dict.fromkeys(round(TEMPERATURE + step * index, 2) for index in range(samples)))
+
+
+def calls_per_sample(context):
+    # LLM calls an improve sample and its judging take, to keep a round within the call cap
+    judge_calls = 1 if context.local_judge or context.fused_judge else 3
+    return 1 + judge_calls * (len(CANDIDATE_VARIANTS) if context.tournament else 1)
+
+
+def round_fan_out(context, samples, max_llm_calls):
+    if not max_llm_calls:
+        return samples
+    affordable = (max_llm_calls - context.request_count) // calls_per_sample(context)
+    # The first round always runs, so there's a result to return
+    return max(1, min(samples, affordable)) if not context.suggestions else min(samples, affordable)
+
+
 def update_suggestions(critique_dict, iteration, context):
     """
     Gets weighted score for new suggestion,
@@ -116,7 +276,7 @@ def update_suggestions(critique_dict, iteration, context):
         critique_dict["constructive"] = context.improvement_result["constructive"]
     context.suggestions.append(critique_dict)
     context.suggestions = sorted(context.suggestions, key=lambda x: x["overall_score"], reverse=True)[
-        :2
+        :context.keep_suggestions
     ]
     critique_dict["request_count"] = context.request_count
     if context.verbose:
@@ -142,7 +302,7 @@ def done_log(context):
     log_to_jsonl("inputs_and_outputs.jsonl", log_entry)
 
 
-def improvement_loop(
+async def improvement_loop_async(
     input_text,
     max_iterations=3,
     good_score=0.85,
@@ -150,50 +310,530 @@ def improvement_loop(
     good_score_if_late=0.7,
     deadline_seconds=60,
     verbose=True,
+    fused_judge=FUSED_JUDGE,
+    use_cache=True,
+    calm_threshold=CALM_THRESHOLD,
+    local_judge=LOCAL_JUDGE,
+    tournament=CANDIDATE_TOURNAMENT,
+    samples=SPECULATIVE_SAMPLES,
+    keep_suggestions=KEEP_SUGGESTIONS,
+    max_llm_calls=MAX_LLM_CALLS,
+    on_update=None,
 ):
+    # Most input is calm already, a local toxicity score under calm_threshold returns it unchanged, with no LLM calls
+    if calm_threshold:
+        start_time = time()
+        toxicity = (await toxicity_scores_async([input_text]))[0]
+        if toxicity < calm_threshold:
+            if verbose: print(f"Toxicity of {toxicity:.3f} is under {calm_threshold}, leaving the text as it is")
+            return identity_result(input_text, toxicity, max_iterations, start_time)
+
     context = ImprovementContext()
     context.original_text = input_text
     context.verbose = verbose
+    context.fused_judge = fused_judge
+    context.local_judge = local_judge
+    context.tournament = tournament
+    context.keep_suggestions = keep_suggestions
+    context.on_update = on_update
+    context.use_cache = use_cache
     time_used = 0
+    iteration_timings = []
+    deadline_exceeded = False
 
-    for iteration in range(1, max_iterations + 1):
-        context.improvement_result = improve_text_attempt(context)
-        context.last_edit = context.improvement_result["hybrid"]
-        critique_dict = critique_text(context)
-        overall_score = update_suggestions(critique_dict, iteration, context)
-        good_attempt = iteration >= min_iterations and overall_score >= good_score
-        time_used = time() - context.start_time
-        too_long = time_used > deadline_seconds and overall_score >= good_score_if_late
-        if good_attempt or too_long:
-            break
+    # Every LLM call's timing is collected, to see if time went on prompt size, the provider or retries
+    with collect_calls() as calls:
+        for iteration in range(1, max_iterations + 1):
+            iteration_start = time()
+            first_call = len(calls)
+            # Each call gets the time left until the deadline, and is cancelled when it runs out, once there
+            # is a suggestion to return instead. The first iteration waits, as there's nothing to return yet.
+            context.deadline = context.start_time + deadline_seconds if context.suggestions else None
+            fan_out = round_fan_out(context, samples, max_llm_calls)
+            if fan_out < 1:
+                if verbose: print(f"Stopping before iteration {iteration}, the cap of {max_llm_calls} LLM calls is near")
+                break
+            # Samples are judged as they are generated, all at once, a round keeps the ones done by the deadline
+            outcomes = await asyncio.gather(
+                *[
+                    improve_sample_async(context, temperature, stream_edit=index == 0)
+                    for index, temperature in enumerate(sample_temperatures(fan_out))
+                ],
+                return_exceptions=True,
+            )
+            finished = [outcome for outcome in outcomes if not isinstance(outcome, BaseException)]
+            errors = [outcome for outcome in outcomes if isinstance(outcome, BaseException)]
+            # Only cut off calls mean the deadline passed, other errors, timeouts included, are the call's own
+            deadline_exceeded = any(isinstance(error, DeadlineExceeded) for error in errors)
+            failures = [error for error in errors if not isinstance(error, DeadlineExceeded)]
+            if not finished:
+                if not deadline_exceeded:
+                    raise failures[0]
+                # The unscored attempt is dropped, the result is from the iterations that finished
+                if verbose: print(f"Deadline of {deadline_seconds} seconds reached in iteration {iteration}, stopping")
+                break
+            for error in failures:
+                print(f"A sample failed, continuing with the {len(finished)} that finished: {error!r}")
+            iteration_timings.append({
+                "iteration": iteration,
+                "seconds": round(time() - iteration_start, 4),
+                "samples": len(finished),
+                "stages": stage_breakdown(calls[first_call:]),
+            })
+            scores = []
+            for improvement_result, edit, critique_dict in finished:
+                context.improvement_result = improvement_result
+                context.last_edit = edit
+                scores.append(update_suggestions(critique_dict, iteration, context))
+            overall_score = max(scores)
+            # The round's best sample's variants are the ones returned with the result
+            context.improvement_result = finished[scores.index(overall_score)][0]
+            if context.on_update:
+                context.on_update({
+                    "event": "iteration",
+                    "iteration": iteration,
+                    "suggestion": dict(context.suggestions[0]),
+                    "time_used": time() - context.start_time,
+                })
+            if deadline_exceeded:
+                break
+            good_attempt = iteration >= min_iterations and overall_score >= good_score
+            time_used = time() - context.start_time
+            too_long = time_used > deadline_seconds and overall_score >= good_score_if_late
+            if good_attempt or too_long:
+                break
 
     assert len(context.suggestions) > 0
+    time_used = time() - context.start_time
     if verbose: print("Stopping\nTop suggestion:\n", json.dumps(context.suggestions[0], indent=4))
     context.suggestions[0].update({
         "input": context.original_text,
-        "iteration_count": iteration, 
-        "max_allowed_iterations": max_iterations, 
+        "iteration_count": context.iteration,
+        "max_allowed_iterations": max_iterations,
         "time_used": time_used,
+        "deadline_exceeded": deadline_exceeded,
         "worst_terms": context.improvement_result.get("worst_terms", ""),
         "worst_fix": context.improvement_result.get("worst_fix", ""),
         "perspective": context.improvement_result.get("nvc", ""),
-        "constructive": context.improvement_result.get("constructive", "")
+        "constructive": context.improvement_result.get("constructive", ""),
+        "timings": {"iterations": iteration_timings, "stages": stage_breakdown(calls), "calls": calls},
     })
     done_log(context)
     return context.suggestions[0]
 
 
+def improvement_loop(
+    input_text,
+    max_iterations=3,
+    good_score=0.85,
+    min_iterations=2,
+    good_score_if_late=0.7,
+    deadline_seconds=60,
+    verbose=True,
+    fused_judge=FUSED_JUDGE,
+    use_cache=True,
+    calm_threshold=CALM_THRESHOLD,
+    local_judge=LOCAL_JUDGE,
+    tournament=CANDIDATE_TOURNAMENT,
+    samples=SPECULATIVE_SAMPLES,
+    keep_suggestions=KEEP_SUGGESTIONS,
+    max_llm_calls=MAX_LLM_CALLS,
+    on_update=None,
+):
+    """
+    Synchronous wrapper around improvement_loop_async, taking the same arguments.
+    Many translations can run concurrently on one event loop by awaiting improvement_loop_async instead.
+    """
+    return run_sync(
+        improvement_loop_async(
+            input_text,
+            max_iterations,
+            good_score,
+            min_iterations,
+            good_score_if_late,
+            deadline_seconds,
+            verbose,
+            fused_judge,
+            use_cache,
+            calm_threshold,
+            local_judge,
+            tournament,
+            samples,
+            keep_suggestions,
+            max_llm_calls,
+            on_update,
+        )
+    )
+
+
+# Progressive results, so a user sees the first edit as it is written, rather than waiting for the whole loop.
+# Updates are dicts with an "event" of:
+# - "partial": "edit" is the first improve request's hybrid edit so far, from workers that stream (http, in_memory)
+# - "iteration": "suggestion" is the best suggestion after that iteration
+# - "done": "result" is what improvement_loop would return
+
+
+async def improvement_loop_iter_async(input_text, **kwargs):
+    """Async generator of improvement_loop_async's progress updates, taking the same arguments, ending with "done"."""
+    updates = asyncio.Queue()
+    loop = asyncio.get_running_loop()
+
+    def on_update(update):
+        # Partial output can arrive on the in memory worker's thread
+        loop.call_soon_threadsafe(updates.put_nowait, update)
+
+    async def run():
+        try:
+            on_update({"event": "done", "result": await improvement_loop_async(input_text, on_update=on_update, **kwargs)})
+        except Exception as e:
+            on_update({"event": "error", "error": e})
+
+    task = asyncio.ensure_future(run())
+    try:
+        while True:
+            update = await updates.get()
+            if update["event"] == "error":
+                raise update["error"]
+            yield update
+            if update["event"] == "done":
+                return
+    finally:
+        # Stops the loop if the caller stops listening
+        task.cancel()
+
+
+def improvement_loop_iter(input_text, **kwargs):
+    """Synchronous generator version of improvement_loop_iter_async, e.g: for Gradio to stream to the browser."""
+    updates = Queue()
+
+    async def forward():
+        try:
+            async for update in improvement_loop_iter_async(input_text, **kwargs):
+                updates.put(update)
+        except Exception as e:
+            updates.put({"event": "error", "error": e})
+
+    future = asyncio.run_coroutine_threadsafe(forward(), get_background_loop())
+    try:
+        while True:
+            update = updates.get()
+            if update["event"] == "error":
+                raise update["error"]
+            yield update
+            if update["event"] == "done":
+                return
+    finally:
+        future.cancel()
+
+
+# Segmenting mode: long comments are mostly calm, so rather than rewriting the whole text, each sentence
+# is scored with a cheap local toxicity model, only the toxic ones go through improvement_loop, concurrently,
+# and their edits are stitched back into the original text.
+segmenter = None
+
+
+def segment_sentences(text):
+    # Spans keep each sentence's position and trailing whitespace, so edits can be put back in place
+    global segmenter
+    if segmenter is None:
+        import pysbd
+        segmenter = pysbd.Segmenter(language="en", clean=False, char_span=True)
+    return segmenter.segment(text)
+
+
+def toxic_spans(sentences, scores, threshold):
+    # Adjacent toxic sentences are improved together, so they keep each other's context
+    spans = []
+    for sentence, score in zip(sentences, scores):
+        if score < threshold:
+            continue
+        if spans and spans[-1]["end"] == sentence.start:
+            spans[-1]["end"] = sentence.end
+            spans[-1]["toxicity"] = max(spans[-1]["toxicity"], score)
+        else:
+            spans.append({"start": sentence.start, "end": sentence.end, "toxicity": score})
+    return spans
+
+
+def stitch_edits(text, spans, key="edit"):
+    parts = []
+    position = 0
+    for span in spans:
+        original = text[span["start"]:span["end"]]
+        trailing_space = original[len(original.rstrip()):]
+        parts.append(text[position:span["start"]])
+        parts.append((span["result"].get(key) or original).strip() + trailing_space)
+        position = span["end"]
+    parts.append(text[position:])
+    return "".join(parts)
+
+
+def identity_result(input_text, toxicity, max_iterations, start_time):
+    # The usual result shape, for a text that is calm enough to leave as it is.
+    # The toxicity is mapped onto the LLM's spicy scale, as local_judge does, so scores compare with edited texts'.
+    spicy_score = spicy_from_toxicity(toxicity)
+    return {
+        "critique": "The text is already calm, so it was left unchanged.",
+        "faithfulness_score": 1.0,
+        "spicy_score": spicy_score,
+        "overall_score": round(calculate_overall_score(1.0, spicy_score), 2),
+        "edit": input_text,
+        "request_count": 0,
+        "input": input_text,
+        "iteration_count": 0,
+        "max_allowed_iterations": max_iterations,
+        "time_used": time() - start_time,
+        "deadline_exceeded": False,
+        "worst_terms": [],
+        "worst_fix": input_text,
+        "perspective": input_text,
+        "constructive": input_text,
+        "timings": {"iterations": [], "stages": {}, "calls": []},
+    }
+
+
+def merge_span_results(input_text, spans, max_iterations, start_time):
+    results = [span["result"] for span in spans]
+    # Scores are for the rewritten spans only, weighted by their length
+    lengths = [span["end"] - span["start"] for span in spans]
+
+    def weighted(key):
+        return round(sum(result[key] * length for result, length in zip(results, lengths)) / sum(lengths), 2)
+
+    calls = [call for result in results for call in result["timings"]["calls"]]
+    return {
+        "critique": " ".join(result["critique"] for result in results),
+        "faithfulness_score": weighted("faithfulness_score"),
+        "spicy_score": weighted("spicy_score"),
+        "overall_score": weighted("overall_score"),
+        "edit": stitch_edits(input_text, spans),
+        "request_count": sum(result["request_count"] for result in results),
+        "input": input_text,
+        "iteration_count": max(result["iteration_count"] for result in results),
+        "max_allowed_iterations": max_iterations,
+        "time_used": time() - start_time,
+        "deadline_exceeded": any(result["deadline_exceeded"] for result in results),
+        "worst_terms": [term for result in results for term in result["worst_terms"] or []],
+        "worst_fix": stitch_edits(input_text, spans, "worst_fix"),
+        "perspective": stitch_edits(input_text, spans, "perspective"),
+        "constructive": stitch_edits(input_text, spans, "constructive"),
+        "timings": {"iterations": [], "stages": stage_breakdown(calls), "calls": calls},
+        "segments": [
+            {"start": span["start"], "end": span["end"], "toxicity": round(span["toxicity"], 4), "edit": span["result"]["edit"]}
+            for span in spans
+        ],
+    }
+
+
+async def improve_toxic_sentences_async(input_text, threshold=SEGMENT_TOXICITY_THRESHOLD, max_iterations=3, **kwargs):
+    """
+    Segmenting mode of improvement_loop_async, taking the same arguments, and returning a result of the same shape.
+    The result's "segments" lists the rewritten spans of the original text, with their toxicity scores.
+    """
+    start_time = time()
+    sentences = segment_sentences(input_text)
+    scores = await toxicity_scores_async([sentence.sent for sentence in sentences])
+    spans = toxic_spans(sentences, scores, threshold)
+    if kwargs.get("verbose", True):
+        toxic_count = sum(score >= threshold for score in scores)
+        print(f"{toxic_count} of {len(sentences)} sentences are toxic enough to improve, in {len(spans)} spans")
+    if not spans:
+        return identity_result(input_text, max(scores, default=0.0), max_iterations, start_time)
+
+    # The spans are known to be toxic, so they aren't scored again
+    kwargs["calm_threshold"] = 0
+    results = await asyncio.gather(*[
+        improvement_loop_async(input_text[span["start"]:span["end"]].strip(), max_iterations=max_iterations, **kwargs)
+        for span in spans
+    ])
+    for span, result in zip(spans, results):
+        span["result"] = result
+    return merge_span_results(input_text, spans, max_iterations, start_time)
+
+
+def improve_toxic_sentences(input_text, **kwargs):
+    """Synchronous wrapper around improve_toxic_sentences_async, taking the same arguments."""
+    return run_sync(improve_toxic_sentences_async(input_text, **kwargs))
+
+
+# Batches, e.g: backfilling a moderation queue. Items are read lazily and improved by a bounded pool of tasks,
+# so a stream of tens of thousands of texts never has more than a few in memory, and results come out as
+# each one finishes. Their LLM calls are scheduled as "batch" work, behind interactive requests.
+
+
+async def improve_stream(items, concurrency=BATCH_CONCURRENCY, segment=False, **kwargs):
+    """
+    Async generator improving an iterable of (item_id, text) pairs, yielding (item_id, result, error)
+    as each one finishes, in completion order. A failed item has a result of None and the error message,
+    rather than stopping the batch. An item's text can also be the exception from reading it, which fails
+    just that item. Keyword arguments are passed on to improvement_loop_async.
+    """
+    kwargs.setdefault("verbose", False)
+    improve = improve_toxic_sentences_async if segment else improvement_loop_async
+    items = iter(items)
+    finished = asyncio.Queue()
+    reader_lock = asyncio.Lock()
+
+    async def next_item():
+        # Reading may block on a file or stdin, so it's kept off the event loop
+        async with reader_lock:
+            return await asyncio.to_thread(next, items, None)
+
+    async def work():
+        try:
+            with scheduling_priority("batch"):
+                while (item := await next_item()) is not None:
+                    item_id, text = item
+                    if isinstance(text, Exception):
+                        # A row that couldn't be read, e.g: invalid JSON, fails on its own
+                        finished.put_nowait((item_id, None, repr(text)))
+                        continue
+                    try:
+                        finished.put_nowait((item_id, await improve(text, **kwargs), None))
+                    except Exception as e:
+                        finished.put_nowait((item_id, None, repr(e)))
+        finally:
+            finished.put_nowait(None)
+
+    tasks = [asyncio.ensure_future(work()) for _ in range(concurrency)]
+    try:
+        running = len(tasks)
+        while running:
+            outcome = await finished.get()
+            if outcome is None:
+                running -= 1
+            else:
+                yield outcome
+        # Raises any error reading the items
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def improvement_loop_batch_async(texts, concurrency=BATCH_CONCURRENCY, **kwargs):
+    """Improves a list of texts, at most concurrency at a time, returning results in the same order, None for failures."""
+    results = [None] * len(texts)
+    async for index, result, error in improve_stream(enumerate(texts), concurrency, **kwargs):
+        if error:
+            print(f"Text {index} failed: {error}")
+        results[index] = result
+    return results
+
+
+def improvement_loop_batch(texts, concurrency=BATCH_CONCURRENCY, **kwargs):
+    """Synchronous wrapper around improvement_loop_batch_async, taking the same arguments."""
+    return run_sync(improvement_loop_batch_async(texts, concurrency, **kwargs))
+
+
+def read_items(lines):
+    """
+    Yields (item_id, text) pairs from JSONL lines with "id" and "text" fields, or from plain text lines.
+    Items without an ID are numbered by line, so a rerun over the same input gets the same IDs.
+    A line that can't be read yields a ValueError in place of its text, so improve_stream fails just that item.
+    """
+    for line_number, line in enumerate(lines, 1):
+        line = line.rstrip("\n")
+        if not line.strip():
+            continue
+        if line.lstrip().startswith("{"):
+            try:
+                item = json.loads(line)
+            except ValueError as e:
+                yield str(line_number), ValueError(f"Invalid JSON on line {line_number}: {e}")
+                continue
+            item_id = str(item.get("id", line_number)) if isinstance(item, dict) else str(line_number)
+            if not isinstance(item, dict) or not isinstance(item.get("text"), str):
+                yield item_id, ValueError(f"No \"text\" string on line {line_number}")
+            else:
+                yield item_id, item["text"]
+        else:
+            yield str(line_number), line
+
+
+def finished_ids(output_path):
+    # IDs already in an output file, so a resumed batch skips them, failed items are retried
+    done = set()
+    try:
+        with open(output_path) as f:
+            for line in f:
+                if line.strip():
+                    try:
+                        output = json.loads(line)
+                    except ValueError:
+                        continue  # A line cut short by an interruption, that item is retried
+                    if isinstance(output, dict) and output.get("result") is not None:
+                        done.add(output["id"])
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def ends_with_newline(path):
+    with open(path, "rb") as f:
+        f.seek(-1, 2)
+        return f.read(1) == b"\n"
+
+
+async def improve_file_async(input_file, output_file, concurrency=BATCH_CONCURRENCY, skip_ids=(), **kwargs):
+    # Writes one JSONL line per item as it finishes, flushed so progress survives an interruption
+    items = (item for item in read_items(input_file) if item[0] not in skip_ids)
+    count = 0
+    async for item_id, result, error in improve_stream(items, concurrency, **kwargs):
+        output = {"id": item_id, "result": result}
+        if error:
+            output["error"] = error
+        output_file.write(json.dumps(output) + "\n")
+        output_file.flush()
+        count += 1
+    return count
+
+
+def improve_file(input_path, output_path=None, concurrency=BATCH_CONCURRENCY, resume=False, **kwargs):
+    """
+    Improves each text of a JSONL or plain text file ("-" for stdin), appending JSONL results to output_path
+    (stdout if not set) as each finishes. With resume, IDs already in the output file are skipped.
+    """
+    skip_ids = finished_ids(output_path) if resume and output_path else set()
+    if skip_ids:
+        print(f"Resuming, skipping {len(skip_ids)} finished items", file=sys.stderr)
+    input_file = sys.stdin if input_path == "-" else open(input_path)
+    output_file = open(output_path, "a") if output_path else sys.stdout
+    if output_file is not sys.stdout and output_file.tell() and not ends_with_newline(output_path):
+        output_file.write("\n")  # Don't append to a line cut short by an interruption
+    start_time = time()
+    try:
+        # Progress messages go to stderr, so stdout only has the results
+        with redirect_stdout(sys.stderr):
+            count = run_sync(improve_file_async(input_file, output_file, concurrency, skip_ids, **kwargs))
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+        if output_file is not sys.stdout:
+            output_file.close()
+    print(f"Improved {count} texts in {time() - start_time:.2f} seconds", file=sys.stderr)
+    return count
+
+
 if __name__ == "__main__":
     parser = ArgumentParser(description="Process and improve text.")
     parser.add_argument(
         "-t", "--text", type=str, help="Text to be improved", default=original_text
     )
+    parser.add_argument(
+        "--segment", action="store_true", help="Only improve the sentences a local toxicity model finds toxic (needs pysbd and detoxify)"
+    )
+    parser.add_argument(
+        "-i", "--input", type=str, help='Batch mode: a JSONL file of {"id", "text"} objects, or plain text with one text per line, "-" for stdin'
+    )
+    parser.add_argument("-o", "--output", type=str, help="Batch mode: JSONL file the results are appended to, defaults to stdout")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY, help="Batch mode: texts improved at once")
+    parser.add_argument("--resume", action="store_true", help="Batch mode: skip IDs already in the output file")
     args = parser.parse_args()
 
-    improvement_loop(args.text)
-
-# TODO: Segment the text into sentences for parallel processing, and isolate the most problematic parts for improvement
-"""
-# import pysbd
-# sentences = pysbd.Segmenter(language="en", clean=False).segment(paragraph)
-"""
+    if args.input:
+        improve_file(args.input, args.output, args.concurrency, args.resume, segment=args.segment)
+    elif args.segment:
+        improve_toxic_sentences(args.text)
+    else:
+        improvement_loop(args.text)
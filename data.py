@@ -1,4 +1,4 @@
-import requests
+import http_pool
 import json
 import os
 import threading
@@ -21,7 +21,7 @@ def log_to_jsonl(file_path, data):
 
         # Make the HTTP POST request
         try:
-            response = requests.post(url, data=json_data, headers={"Content-Type": "application/json"})
+            response = http_pool.post(url, data=json_data, headers={"Content-Type": "application/json"})
 
             # Check if the request was successful
             if response.status_code == 200:
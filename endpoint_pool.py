@@ -0,0 +1,175 @@
+import asyncio
+from collections import deque
+from contextlib import contextmanager
+from os import environ as env
+from threading import Lock, Thread
+from time import sleep, time
+import http_pool
+from rate_limit import RateLimitedError
+from stats import LATENCY_WINDOW, percentile
+
+# Load balancing for the http worker, across several llama.cpp servers running the same model.
+# Each request goes to the healthy endpoint with the fewest requests outstanding, ties go to the faster one.
+# After LLM_HTTP_EJECT_AFTER failures in a row an endpoint is ejected for LLM_HTTP_EJECT_SECONDS,
+# then it gets one trial request, and is ejected again straight away if that fails too.
+# A background thread also polls each server's /health every LLM_HTTP_HEALTH_INTERVAL seconds (0 to disable).
+
+LLM_HTTP_EJECT_AFTER = int(env.get("LLM_HTTP_EJECT_AFTER", 3))
+LLM_HTTP_EJECT_SECONDS = float(env.get("LLM_HTTP_EJECT_SECONDS", 30))
+LLM_HTTP_HEALTH_INTERVAL = float(env.get("LLM_HTTP_HEALTH_INTERVAL", 10))
+LLM_HTTP_HEALTH_TIMEOUT = float(env.get("LLM_HTTP_HEALTH_TIMEOUT", 2))
+
+
+class EndpointError(ValueError):
+    pass
+
+
+def health_url(url):
+    # llama.cpp servers serve /health next to the OpenAI style /v1/... routes
+    base = url.split("/v1/")[0] if "/v1/" in url else url.rstrip("/")
+    return f"{base}/health"
+
+
+class Endpoint:
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.stats = {"requests": 0, "failures": 0, "ejections": 0}
+
+    def is_available(self, now):
+        return self.ejected_until <= now
+
+    def mean_latency(self):
+        return sum(self.latencies) / len(self.latencies) if self.latencies else None
+
+
+class EndpointPool:
+    def __init__(self, urls):
+        assert urls, "At least one endpoint URL is needed"
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.lock = Lock()
+        self.health_thread = None
+
+    def pick(self, exclude=()) -> Endpoint:
+        """
+        Takes the least loaded available endpoint, counting the request as outstanding on it.
+        Endpoints in exclude, e.g: ones a request already failed on, are only used if there's nothing else.
+        """
+        with self.lock:
+            now = time()
+            candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude] or self.endpoints
+            available = [endpoint for endpoint in candidates if endpoint.is_available(now)]
+            if available:
+                # An endpoint without latency samples yet is taken to be as fast as the average one, not the fastest
+                latencies = [latency for latency in (e.mean_latency() for e in self.endpoints) if latency is not None]
+                default_latency = sum(latencies) / len(latencies) if latencies else 0.0
+
+                def load(e):
+                    # Failures in a row count as extra load, as a failing server answers fast and would look idle
+                    latency = e.mean_latency()
+                    return e.outstanding + e.consecutive_failures, default_latency if latency is None else latency
+
+                endpoint = min(available, key=load)
+            else:
+                # Everything is ejected, try the one due back soonest rather than failing outright
+                endpoint = min(candidates, key=lambda e: e.ejected_until)
+            endpoint.outstanding += 1
+            endpoint.stats["requests"] += 1
+            return endpoint
+
+    def release(self, endpoint):
+        with self.lock:
+            endpoint.outstanding -= 1
+
+    def record_success(self, endpoint, seconds):
+        with self.lock:
+            endpoint.outstanding -= 1
+            endpoint.consecutive_failures = 0
+            endpoint.ejected_until = 0.0
+            endpoint.latencies.append(seconds)
+
+    def record_failure(self, endpoint, error):
+        with self.lock:
+            endpoint.outstanding -= 1
+            endpoint.stats["failures"] += 1
+            endpoint.consecutive_failures += 1
+            if endpoint.consecutive_failures >= LLM_HTTP_EJECT_AFTER:
+                self.eject(endpoint)
+        print(f"Endpoint {endpoint.url} failed ({endpoint.consecutive_failures} in a row): {error}")
+
+    def eject(self, endpoint):
+        # Caller holds the lock
+        if endpoint.ejected_until <= time():
+            endpoint.stats["ejections"] += 1
+            print(f"Ejecting endpoint {endpoint.url} for {LLM_HTTP_EJECT_SECONDS} seconds")
+        endpoint.ejected_until = time() + LLM_HTTP_EJECT_SECONDS
+
+    @contextmanager
+    def use(self, exclude=()):
+        """Use as "with pool.use() as endpoint:", works around both sync and async requests."""
+        endpoint = self.pick(exclude)
+        start_time = time()
+        try:
+            yield endpoint
+        except (RateLimitedError, asyncio.CancelledError, KeyboardInterrupt):
+            # A busy server, or a caller giving up, doesn't mean the endpoint is broken
+            self.release(endpoint)
+            raise
+        except BaseException as e:
+            self.record_failure(endpoint, e)
+            raise
+        self.record_success(endpoint, time() - start_time)
+
+    def failover_attempts(self):
+        # How many endpoints a request can be tried on, if it fails before any output arrives
+        return len(self.endpoints)
+
+    def check_health(self):
+        """Polls every endpoint's /health, ejecting unhealthy ones and restoring healthy ones."""
+        results = {}
+        for endpoint in self.endpoints:
+            try:
+                response = http_pool.get(health_url(endpoint.url), timeout=LLM_HTTP_HEALTH_TIMEOUT)
+                healthy = response.status_code == 200
+            except Exception as e:
+                print(f"Health check for {endpoint.url} failed: {e}")
+                healthy = False
+            with self.lock:
+                if healthy:
+                    endpoint.consecutive_failures = 0
+                    endpoint.ejected_until = 0.0
+                else:
+                    self.eject(endpoint)
+            results[endpoint.url] = healthy
+        return results
+
+    def start_health_checks(self, interval=LLM_HTTP_HEALTH_INTERVAL):
+        if interval <= 0 or self.health_thread is not None:
+            return
+
+        def run():
+            while True:
+                sleep(interval)
+                self.check_health()
+
+        self.health_thread = Thread(target=run, daemon=True, name="endpoint-health-checks")
+        self.health_thread.start()
+
+    def get_stats(self):
+        """Returns load, failure and latency stats for each endpoint, keyed by URL."""
+        stats = {}
+        with self.lock:
+            now = time()
+            for endpoint in self.endpoints:
+                latencies = list(endpoint.latencies)
+                stats[endpoint.url] = dict(
+                    endpoint.stats,
+                    outstanding=endpoint.outstanding,
+                    ejected_for=max(endpoint.ejected_until - now, 0.0),
+                    p50_seconds=percentile(latencies, 0.5),
+                    p95_seconds=percentile(latencies, 0.95),
+                )
+        return stats
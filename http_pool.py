@@ -0,0 +1,194 @@
+import asyncio
+from os import environ as env
+from threading import Lock
+
+# A shared HTTP session, so the LLM workers and the log shipper reuse keep-alive connections
+# instead of paying for a new TCP/TLS handshake on every request.
+# requests.Session is safe to share between threads for our use (no cookies are relied on),
+# the underlying urllib3 pools hand out one connection per thread at a time.
+
+# Number of different hosts to keep pools for, and the max connections kept open per host:
+HTTP_POOL_HOSTS = int(env.get("HTTP_POOL_HOSTS", 10))
+HTTP_POOL_MAXSIZE = int(env.get("HTTP_POOL_MAXSIZE", 16))
+# When true, requests wait for a free connection instead of opening extra ones beyond HTTP_POOL_MAXSIZE:
+HTTP_POOL_BLOCK = env.get("HTTP_POOL_BLOCK", "true").lower() == "true"
+HTTP_CONNECT_TIMEOUT = float(env.get("HTTP_CONNECT_TIMEOUT", 10))
+HTTP_READ_TIMEOUT = float(env.get("HTTP_READ_TIMEOUT", 120))
+
+_session = None
+_session_lock = Lock()
+
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                # Imported here, so importing this module stays cheap
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=HTTP_POOL_HOSTS,
+                    pool_maxsize=HTTP_POOL_MAXSIZE,
+                    pool_block=HTTP_POOL_BLOCK,
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+    return _session
+
+
+def request(method, url, timeout=None, **kwargs):
+    # timeout can be a single number or a (connect, read) tuple like requests accepts
+    if timeout is None:
+        timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    return get_session().request(method, url, timeout=timeout, **kwargs)
+
+
+def post(url, timeout=None, **kwargs):
+    return request("POST", url, timeout=timeout, **kwargs)
+
+
+def get(url, timeout=None, **kwargs):
+    return request("GET", url, timeout=timeout, **kwargs)
+
+
+def pool_stats():
+    """
+    Returns connection reuse metrics for each host pool, keyed by "scheme://host:port",
+    and for the async workers' aiohttp connections to each host, keyed by "scheme://host:port (aiohttp)".
+    """
+    stats = {f"{host} (aiohttp)": host_stats for host, host_stats in async_pool_stats().items()}
+    if _session is None:
+        return stats
+    adapters = {id(adapter): adapter for adapter in _session.adapters.values()}
+    for adapter in adapters.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests_made = pool.num_requests
+            connections_opened = pool.num_connections
+            stats[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                "requests": requests_made,
+                "connections_opened": connections_opened,
+                "connections_reused": max(requests_made - connections_opened, 0),
+                # The pool queue is pre-filled with None placeholders, only real connections count as idle
+                "idle_connections": sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool is not None else 0,
+            }
+    return stats
+
+
+def close_session():
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+# The async workers use aiohttp, with one keep-alive session per event loop.
+# aiohttp is only imported when an async worker is first used.
+# Its connector always waits for a free connection at HTTP_POOL_MAXSIZE per host,
+# HTTP_POOL_BLOCK only applies to the requests session.
+# aiohttp doesn't count requests or connections, so they're counted with trace hooks for pool_stats().
+# A session is closed, and forgotten, when its loop shuts down: asyncio.run() cancels the tasks still pending
+# once its coroutine returns, including the one waiting to close the session. A loop that's stopped another way,
+# e.g: loop.close() without cancelling its tasks, should await close_async_session() on it first.
+_async_sessions = {}
+_session_closers = {}  # Loop -> the task closing its session at shutdown, the loop only keeps weak references to tasks
+_async_stats = {}  # "scheme://host:port" -> counts, across every loop's session
+_async_stats_lock = Lock()
+
+
+def count_async(trace_config_ctx, name):
+    with _async_stats_lock:
+        host_stats = _async_stats.setdefault(
+            trace_config_ctx.host,
+            {"requests": 0, "connections_opened": 0, "connections_reused": 0, "waited_for_connection": 0},
+        )
+        host_stats[name] += 1
+
+
+async def on_request_start(session, trace_config_ctx, params):
+    trace_config_ctx.host = f"{params.url.scheme}://{params.url.host}:{params.url.port}"
+    count_async(trace_config_ctx, "requests")
+
+
+async def on_connection_create_end(session, trace_config_ctx, params):
+    count_async(trace_config_ctx, "connections_opened")
+
+
+async def on_connection_reuseconn(session, trace_config_ctx, params):
+    count_async(trace_config_ctx, "connections_reused")
+
+
+async def on_connection_queued_start(session, trace_config_ctx, params):
+    count_async(trace_config_ctx, "waited_for_connection")
+
+
+def async_pool_stats():
+    with _async_stats_lock:
+        return {host: dict(host_stats) for host, host_stats in _async_stats.items()}
+
+
+def pool_trace_config():
+    import aiohttp
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+    trace_config.on_connection_queued_start.append(on_connection_queued_start)
+    return trace_config
+
+
+def get_async_session():
+    import aiohttp
+    loop = asyncio.get_running_loop()
+    session = _async_sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=HTTP_POOL_HOSTS * HTTP_POOL_MAXSIZE, limit_per_host=HTTP_POOL_MAXSIZE)
+        session = aiohttp.ClientSession(connector=connector, trace_configs=[pool_trace_config()])
+        _async_sessions[loop] = session
+        if loop in _session_closers:
+            _session_closers[loop].cancel()  # The old session was closed directly
+        _session_closers[loop] = loop.create_task(close_at_shutdown(loop, session))
+    return session
+
+
+async def close_at_shutdown(loop, session):
+    try:
+        await loop.create_future()  # Waits until it's cancelled
+    finally:
+        if _async_sessions.get(loop) is session:
+            del _async_sessions[loop]
+            del _session_closers[loop]
+        await session.close()
+
+
+def async_request(method, url, timeout=None, **kwargs):
+    # Use as "async with async_request(...) as response:", timeout is the total seconds allowed
+    import aiohttp
+    if timeout is None:
+        client_timeout = aiohttp.ClientTimeout(sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT)
+    else:
+        client_timeout = aiohttp.ClientTimeout(total=timeout, sock_connect=HTTP_CONNECT_TIMEOUT)
+    return get_async_session().request(method, url, timeout=client_timeout, **kwargs)
+
+
+def async_post(url, timeout=None, **kwargs):
+    return async_request("POST", url, timeout=timeout, **kwargs)
+
+
+def async_get(url, timeout=None, **kwargs):
+    return async_request("GET", url, timeout=timeout, **kwargs)
+
+
+async def close_async_session():
+    """Closes the running loop's session, a new one is opened if the loop makes more requests."""
+    closer = _session_closers.get(asyncio.get_running_loop())
+    if closer is not None:
+        closer.cancel()
+        await asyncio.gather(closer, return_exceptions=True)
@@ -0,0 +1,163 @@
+import contextvars
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+from contextvars import ContextVar
+from os import environ as env
+from threading import Condition, Thread
+from time import time
+from call_metrics import record_queue_wait
+from stats import LATENCY_WINDOW, percentile
+
+# A scheduler that owns a model which can only run one generation at a time, like the in memory Llama.
+# Callers from any thread (Gradio, the RunPod handler, batch jobs, asyncio tasks) submit jobs,
+# and one scheduler thread runs them in priority order: "interactive" jobs go ahead of "batch" jobs,
+# but a waiting job gains a priority level every SCHEDULER_AGING_SECONDS, so batch work is never starved.
+# Jobs run in submission order within a priority level.
+# The queue is bounded, when it's full new jobs are rejected with QueueFullError rather than waiting forever.
+# llama_cpp's Llama can't evaluate several sequences in one batch, so identical queued jobs
+# (same key, e.g: prompt, schema, temperature and deadline) are coalesced, and run once for all their callers instead.
+
+SCHEDULER_MAX_QUEUE = int(env.get("SCHEDULER_MAX_QUEUE", 32))
+SCHEDULER_AGING_SECONDS = float(env.get("SCHEDULER_AGING_SECONDS", 30))
+PRIORITIES = {"interactive": 0, "batch": 1}
+
+# The priority of jobs submitted from the current context, set with scheduling_priority()
+request_priority = ContextVar("request_priority", default="interactive")
+
+
+@contextmanager
+def scheduling_priority(priority):
+    """Use as "with scheduling_priority("batch"):" around calls that can wait behind interactive ones."""
+    assert priority in PRIORITIES, f"Unknown priority: {priority}"
+    token = request_priority.set(priority)
+    try:
+        yield
+    finally:
+        request_priority.reset(token)
+
+
+class QueueFullError(ValueError):
+    pass
+
+
+class Job:
+    def __init__(self, function, key, priority, sequence):
+        self.function = function
+        self.key = key
+        self.priority = priority
+        self.sequence = sequence
+        self.submitted_at = time()
+        self.waited = 0.0
+        # Each caller gets its own future, so one caller cancelling doesn't cancel a coalesced job for the rest
+        self.futures = []
+        # The job runs in the submitter's context, so context variables like the partial output listener still apply
+        self.context = contextvars.copy_context()
+
+    def effective_priority(self, now):
+        return PRIORITIES[self.priority] - (now - self.submitted_at) / SCHEDULER_AGING_SECONDS
+
+
+class Scheduler:
+    def __init__(self, name, max_queue=SCHEDULER_MAX_QUEUE):
+        self.name = name
+        self.max_queue = max_queue
+        self.queue = []  # Short, so the next job is found by a scan, which lets waiting jobs age
+        self.queued_by_key = {}
+        self.condition = Condition()
+        self.sequence = 0
+        self.thread = None
+        self.running = None
+        self.waits = deque(maxlen=LATENCY_WINDOW)
+        self.stats = {"submitted": 0, "coalesced": 0, "rejected": 0, "cancelled": 0, "completed": 0, "failed": 0, "run_seconds": 0.0}
+
+    def submit(self, function, key=None, priority=None) -> Future:
+        """Queues function() to run on the scheduler thread, returning a Future for its result."""
+        priority = priority or request_priority.get()
+        future = Future()
+        with self.condition:
+            self.stats["submitted"] += 1
+            job = self.queued_by_key.get(key) if key is not None else None
+            if job is not None:
+                # Coalesce with an identical queued job, at the more urgent of the two priorities
+                self.stats["coalesced"] += 1
+                if PRIORITIES[priority] < PRIORITIES[job.priority]:
+                    job.priority = priority
+            else:
+                if len(self.queue) >= self.max_queue:
+                    self.stats["rejected"] += 1
+                    raise QueueFullError(f"{self.name} scheduler queue is full with {len(self.queue)} jobs")
+                self.sequence += 1
+                job = Job(function, key, priority, self.sequence)
+                self.queue.append(job)
+                if key is not None:
+                    self.queued_by_key[key] = job
+            job.futures.append(future)
+            self.start()
+            self.condition.notify()
+        return future
+
+    def run(self, function, key=None, priority=None):
+        # Blocks the calling thread until the job has run
+        return self.submit(function, key, priority).result()
+
+    def start(self):
+        # Caller holds the condition lock
+        if self.thread is None:
+            self.thread = Thread(target=self.loop, daemon=True, name=f"{self.name}-scheduler")
+            self.thread.start()
+
+    def next_job(self):
+        # Caller holds the condition lock
+        now = time()
+        job = min(self.queue, key=lambda queued: (queued.effective_priority(now), queued.sequence))
+        self.queue.remove(job)
+        if job.key is not None:
+            self.queued_by_key.pop(job.key, None)
+        job.waited = now - job.submitted_at
+        self.waits.append(job.waited)
+        return job
+
+    def loop(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                job = self.next_job()
+                self.running = job
+            futures = [future for future in job.futures if future.set_running_or_notify_cancel()]
+            if not futures:
+                with self.condition:
+                    self.stats["cancelled"] += 1
+                    self.running = None
+                continue
+            start_time = time()
+            try:
+                job.context.run(record_queue_wait, job.waited)
+                result = job.context.run(job.function)
+            except BaseException as e:
+                for future in futures:
+                    future.set_exception(e)
+                outcome = "failed"
+            else:
+                for future in futures:
+                    future.set_result(result)
+                outcome = "completed"
+            with self.condition:
+                self.stats[outcome] += 1
+                self.stats["run_seconds"] += time() - start_time
+                self.running = None
+
+    def get_stats(self):
+        """Returns queue depth per priority, job counts and queue wait times."""
+        with self.condition:
+            stats = dict(self.stats)
+            stats["queue_depth"] = {priority: 0 for priority in PRIORITIES}
+            for job in self.queue:
+                stats["queue_depth"][job.priority] += 1
+            stats["running"] = self.running is not None
+            waits = list(self.waits)
+        stats["wait_p50_seconds"] = percentile(waits, 0.5)
+        stats["wait_p95_seconds"] = percentile(waits, 0.95)
+        stats["wait_max_seconds"] = max(waits) if waits else None
+        return stats
@@ -0,0 +1,66 @@
+import asyncio
+from os import environ as env
+from threading import Lock
+from typing import List
+from toxicity import toxicity_scores_async
+
+# Scores edits with local CPU models instead of the faithfulness and spiciness LLM prompts, as local_score.py explores:
+# - faithfulness_score: sentence embedding cosine similarity of the edit to the original text
+# - spicy_score: the Detoxify toxicity of the edit
+# Both are mapped onto the 0 to 1 scales the LLM prompts use, so calculate_overall_score works the same way.
+# Many edits of one text are scored in one batch, e.g: all the variants of an improve call.
+# Needs: pip install sentence-transformers detoxify
+
+LOCAL_JUDGE = env.get("LOCAL_JUDGE", "false").lower() == "true"
+SIMILARITY_MODEL = env.get("SIMILARITY_MODEL", "all-MiniLM-L6-v2")
+# Unrelated sentences have a cosine similarity of about this, it maps to a faithfulness of 0, and identical text to 1.
+# Close paraphrases score around 0.85 to 0.95, mapping to faithfulness scores like the LLM gives them.
+SIMILARITY_FLOOR = float(env.get("SIMILARITY_FLOOR", 0.3))
+# Detoxify probabilities are near 0 for anything short of abuse, raising them to a power under 1 spreads
+# mildly rude text out over the scale, like the LLM's spicy scores: 0.01 becomes 0.1, and 0.25 becomes 0.5.
+SPICY_EXPONENT = float(env.get("SPICY_EXPONENT", 0.5))
+
+similarity_model = None
+similarity_model_lock = Lock()
+similarity_encode_lock = Lock()
+
+
+def load_similarity_model():
+    global similarity_model
+    with similarity_model_lock:
+        if similarity_model is None:
+            from sentence_transformers import SentenceTransformer
+            print(f"Loading {SIMILARITY_MODEL} sentence similarity model")
+            similarity_model = SentenceTransformer(SIMILARITY_MODEL, device="cpu")
+    return similarity_model
+
+
+def similarities(original_text: str, edits: List[str]) -> List[float]:
+    """Cosine similarity of each edit to the original text, encoded in one batch."""
+    from sentence_transformers import util
+    model = load_similarity_model()
+    with similarity_encode_lock:
+        embeddings = model.encode([original_text] + list(edits), convert_to_tensor=True)
+    return [float(score) for score in util.cos_sim(embeddings[0:1], embeddings[1:])[0]]
+
+
+def faithfulness_from_similarity(similarity):
+    return round(min(1.0, max(0.0, (similarity - SIMILARITY_FLOOR) / (1 - SIMILARITY_FLOOR))), 2)
+
+
+def spicy_from_toxicity(toxicity):
+    return round(min(1.0, max(0.0, toxicity) ** SPICY_EXPONENT), 2)
+
+
+async def local_judgements_async(original_text: str, edits: List[str]) -> List[dict]:
+    """Returns a dict with faithfulness_score and spicy_score for each edit, scored on the CPU."""
+    if not edits:
+        return []
+    similarity_scores, toxicity_scores = await asyncio.gather(
+        asyncio.to_thread(similarities, original_text, edits),
+        toxicity_scores_async(edits),
+    )
+    return [
+        {"faithfulness_score": faithfulness_from_similarity(similarity), "spicy_score": spicy_from_toxicity(toxicity)}
+        for similarity, toxicity in zip(similarity_scores, toxicity_scores)
+    ]
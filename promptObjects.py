@@ -1,4 +1,7 @@
-from typing import List
+import json
+import re
+from functools import lru_cache
+from typing import List, Optional
 from pydantic import BaseModel, Field
 
 improve_prompt = """
@@ -34,28 +37,22 @@ Example improved text outputs:
  "constructive": "I often feel frustrated by you. I rarely feel you listen to me. How can we improve our communication?",
  "hybrid": "You're often frustrating me. It feels like you often don't listen to me."}
 End of example.
+Provide your improved version in the required JSON format.
+To get a good answer, make the original text non-inflamitory, while being as faithful to the original text as much as possible. 
+Use valid JSON then stop, the required keys are: worst_terms, worst_fix, nvc, constructive, best.
+Do not add any remarks before or after the JSON!
+
 Here is the real input text to improve:
 `{original_text}`
 
 Previous rephrasing attempts:
 {previous_suggestions}
-
-Provide your improved version in the required JSON format.
-To get a good answer, make the original text non-inflamitory, while being as faithful to the original text as much as possible. 
-Use valid JSON then stop, the required keys are: worst_terms, worst_fix, nvc, constructive, best.
-Do not add any remarks before or after the JSON!
 """
 
 critique_prompt = """
 Critique the text. We prefer the edit prevent inflaming discussions!
 We also prefer concise text, and a similar semantic intent to the original.
 
-Here is the original text:
-`{original_text}`
-
-Here is the text to critique:
-`{last_edit}`
-
 Output your response as valid JSON in this format:
 {
     "critique":"STRING",
@@ -65,28 +62,34 @@ E.g:
 {
     "critique":"This is too fluffy and different from the original intent."
 }
-Please critique the text.
-You must output the JSON in the required format only, with no remarks or prefacing remarks - JUST JSON!"""
+You must output the JSON in the required format only, with no remarks or prefacing remarks - JUST JSON!
+
+Here is the original text:
+`{original_text}`
+
+Here is the text to critique:
+`{last_edit}`
+Please critique the text."""
 
 
 spicy_scorer_prompt = """
 Score the text.
 
 A calm spicy_score of 0 is ideal. A spicy_score of 1 is the worst, very inflammatory text that makes the reader feel attacked.
-
-Here is the original text:
-`{original_text}`
-
-Here is the text to score:
-`{last_edit}`
 The float variable is scored from 0 to 1.
 
 Output your response as valid JSON in this format, then stop:
 {
     "spicy_score":FLOAT
 }
-Please score the text.
 You must output the JSON in the required format only, with no remarks or prefacing remarks - JUST JSON!
+
+Here is the original text:
+`{original_text}`
+
+Here is the text to score:
+`{last_edit}`
+Please score the text.
 """
 
 
@@ -94,23 +97,62 @@ faith_scorer_prompt = """
 Score the text.
 
 A score of 1 would have the same semantic intent as the original text. A score of 0 would mean the text has lost all semantic similarity.
+The float variable is scored from 0 to 1.
+
+Output your response as valid JSON in this format, then stop:
+{
+    "faithfulness_score":FLOAT
+}
+You must output the JSON in the required format only, with no remarks or prefacing remarks - JUST JSON!
 
 Here is the original text:
 `{original_text}`
 
 Here is the new text to score:
 `{last_edit}`
+Please score the text.
+"""
 
-The float variable is scored from 0 to 1.
+judge_prompt = """
+Critique and score the text. We prefer the edit prevent inflaming discussions!
+We also prefer concise text, and a similar semantic intent to the original.
+
+critique: A short critique of the new text.
+faithfulness_score: A float from 0 to 1. A score of 1 would have the same semantic intent as the original text. A score of 0 would mean the text has lost all semantic similarity.
+spicy_score: A float from 0 to 1. A calm spicy_score of 0 is ideal. A spicy_score of 1 is the worst, very inflammatory text that makes the reader feel attacked.
 
 Output your response as valid JSON in this format, then stop:
 {
-    "faithfulness_score":FLOAT
+    "critique":"STRING",
+    "faithfulness_score":FLOAT,
+    "spicy_score":FLOAT
+}
+E.g:
+{
+    "critique":"This is calmer but a little different from the original intent.",
+    "faithfulness_score":0.8,
+    "spicy_score":0.2
 }
-Please score the text.
 You must output the JSON in the required format only, with no remarks or prefacing remarks - JUST JSON!
+
+Here is the original text:
+`{original_text}`
+
+Here is the new text to critique and score:
+`{last_edit}`
+Please critique and score the text.
 """
 
+# The templates above put their static instructions first, and the variable text last,
+# so the in memory worker can reuse the evaluated prefix of each template between calls.
+prompt_templates = [improve_prompt, critique_prompt, spicy_scorer_prompt, faith_scorer_prompt, judge_prompt]
+
+
+def template_prefix(template: str) -> str:
+    """Returns the static start of a template, up to its first {placeholder}."""
+    match = re.search(r"\{[a-z_]+\}", template)
+    return template[:match.start()] if match else template
+
 
 class ImprovedText(BaseModel):
     worst_terms: List[str] = Field(..., description="Array of strings of the worst terms in the text.")
@@ -132,3 +174,41 @@ class FaithfulnessScore(BaseModel):
     faithfulness_score: float = Field(
         ..., description="The faithfulness score of the text."
     )
+
+
+
+class Judgement(BaseModel):
+    critique: str = Field(..., description="The critique of the text.")
+    faithfulness_score: float = Field(
+        ..., description="The faithfulness score of the text."
+    )
+    spicy_score: float = Field(..., description="The spiciness score of the text.")
+
+
+class GenerationBudget(BaseModel):
+    max_tokens: Optional[int] = Field(None, description="Most tokens to generate, None uses the MAX_TOKENS default.")
+    stop: List[str] = Field([], description="Stop sequences, for APIs without grammar constrained output.")
+    temperature: Optional[float] = Field(None, description="Sampling temperature, None uses the TEMPERATURE default.")
+
+
+# Budgets set by hand, keyed by model class name, these take priority over budgets derived from the schema
+generation_budgets = {
+    "Critique": GenerationBudget(max_tokens=300),
+    "Judgement": GenerationBudget(max_tokens=350),
+}
+
+NUMERIC_TYPES = ["number", "integer", "boolean"]
+
+
+@lru_cache(maxsize=128)
+def schema_generation_budget(json_schema: str) -> GenerationBudget:
+    """Returns the generation budget for a JSON schema string, derived from its fields where there is no explicit budget."""
+    schema = json.loads(json_schema)
+    if schema.get("title") in generation_budgets:
+        return generation_budgets[schema["title"]]
+    properties = schema.get("properties", {})
+    if properties and all(field.get("type") in NUMERIC_TYPES for field in properties.values()):
+        # Numbers only, e.g: {"spicy_score": 0.25} is about 10 tokens.
+        # A flat object of numbers can't contain "}" before its end, so it is safe to stop there.
+        return GenerationBudget(max_tokens=16 + 16 * len(properties), stop=["}"])
+    return GenerationBudget()
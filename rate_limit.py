@@ -0,0 +1,234 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from email.utils import parsedate_to_datetime
+from os import environ as env
+from threading import Event, Lock
+from time import sleep, time
+from call_metrics import record_queue_wait
+
+# Per worker rate limiting, usable from threads and from asyncio tasks.
+# Each worker gets a token bucket for requests per second, another for LLM tokens per minute,
+# and a cap on requests in flight. All are configured by environment variables, e.g:
+# MISTRAL_REQUESTS_PER_SECOND=2 MISTRAL_TOKENS_PER_MINUTE=500000 MISTRAL_MAX_IN_FLIGHT=8
+# A value of 0 means no limit.
+# When a provider returns 429, requests pause for the Retry-After time, and the request rate
+# is halved then slowly recovers as requests succeed again.
+
+DEFAULT_REQUESTS_PER_SECOND = {"mistral": 2}
+MIN_RATE_FRACTION = 0.1  # The adaptive rate never drops below this fraction of the configured rate
+RATE_RECOVERY_FRACTION = 0.1  # Fraction of the configured rate recovered per successful request
+DEFAULT_RETRY_AFTER = 1.0
+
+
+class RateLimitedError(ValueError):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    # Retry-After can be a number of seconds or a HTTP date
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    def __init__(self, rate_per_second, capacity=None):
+        self.rate = rate_per_second
+        self.capacity = capacity if capacity is not None else max(rate_per_second, 1)
+        self.tokens = self.capacity
+        self.updated_at = time()
+        self.lock = Lock()
+
+    def refill(self, now):
+        # Caller holds the lock
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, amount=1) -> float:
+        """Takes amount from the bucket, going into debt if needed, and returns the seconds to wait."""
+        if self.rate <= 0:
+            return 0.0
+        with self.lock:
+            now = time()
+            self.refill(now)
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def refund(self, amount):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            self.refill(time())
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class InFlightLimiter:
+    """A semaphore that both threads and asyncio tasks can wait on, handing slots out in FIFO order."""
+
+    def __init__(self, max_in_flight):
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.waiters = deque()
+        self.lock = Lock()
+
+    def has_free_slot(self):
+        # Caller holds the lock
+        return self.max_in_flight <= 0 or self.in_flight < self.max_in_flight
+
+    def acquire(self):
+        with self.lock:
+            if self.has_free_slot():
+                self.in_flight += 1
+                return
+            event = Event()
+            self.waiters.append(event.set)
+        event.wait()  # The releasing caller hands its slot straight to us
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if self.has_free_slot():
+                self.in_flight += 1
+                return
+            future = loop.create_future()
+            self.waiters.append(lambda: loop.call_soon_threadsafe(self.hand_over, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def hand_over(self, future):
+        if future.cancelled():
+            self.release()  # The waiting task gave up, pass the slot on
+        else:
+            future.set_result(None)
+
+    def release(self):
+        with self.lock:
+            if not self.waiters:
+                self.in_flight -= 1
+                return
+            wake = self.waiters.popleft()
+        wake()
+
+
+class WorkerLimiter:
+    def __init__(self, name, requests_per_second=0, tokens_per_minute=0, max_in_flight=0):
+        self.name = name
+        self.configured_rate = requests_per_second
+        self.requests = TokenBucket(requests_per_second)
+        self.tokens = TokenBucket(tokens_per_minute / 60, capacity=tokens_per_minute)
+        self.in_flight = InFlightLimiter(max_in_flight)
+        self.paused_until = 0.0
+        self.lock = Lock()
+        self.stats = {"requests": 0, "throttled": 0, "waited_seconds": 0.0}
+
+    @classmethod
+    def from_env(cls, name):
+        prefix = name.upper()
+        return cls(
+            name,
+            requests_per_second=float(env.get(f"{prefix}_REQUESTS_PER_SECOND", DEFAULT_REQUESTS_PER_SECOND.get(name, 0))),
+            tokens_per_minute=float(env.get(f"{prefix}_TOKENS_PER_MINUTE", 0)),
+            max_in_flight=int(env.get(f"{prefix}_MAX_IN_FLIGHT", 0)),
+        )
+
+    def reserve(self, estimated_tokens) -> float:
+        wait = max(self.requests.reserve(1), self.tokens.reserve(estimated_tokens))
+        with self.lock:
+            wait = max(wait, self.paused_until - time())
+            self.stats["requests"] += 1
+            self.stats["waited_seconds"] += max(wait, 0.0)
+        return max(wait, 0.0)
+
+    def report(self, status_code, retry_after=None):
+        """Adapts the request rate from a response status code and Retry-After header value."""
+        with self.lock:
+            if status_code == 429:
+                self.stats["throttled"] += 1
+                now = time()
+                # Concurrent requests often get throttled together, only slow down once per pause
+                if self.configured_rate > 0 and now >= self.paused_until:
+                    self.requests.rate = max(self.requests.rate / 2, self.configured_rate * MIN_RATE_FRACTION)
+                pause = parse_retry_after(retry_after)
+                self.paused_until = max(self.paused_until, now + (pause if pause is not None else DEFAULT_RETRY_AFTER))
+            elif status_code < 400 and self.configured_rate > 0:
+                self.requests.rate = min(self.requests.rate + self.configured_rate * RATE_RECOVERY_FRACTION, self.configured_rate)
+
+    def report_usage(self, estimated_tokens, used_tokens):
+        # Gives back tokens that were reserved but not used
+        if used_tokens is not None and used_tokens < estimated_tokens:
+            self.tokens.refund(estimated_tokens - used_tokens)
+
+    @contextmanager
+    def limit(self, estimated_tokens=0):
+        start_time = time()
+        self.in_flight.acquire()
+        try:
+            wait = self.reserve(estimated_tokens)
+            if wait > 0:
+                sleep(wait)
+            record_queue_wait(time() - start_time)
+            yield self
+        finally:
+            self.in_flight.release()
+
+    @asynccontextmanager
+    async def limit_async(self, estimated_tokens=0):
+        start_time = time()
+        await self.in_flight.acquire_async()
+        try:
+            wait = self.reserve(estimated_tokens)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            record_queue_wait(time() - start_time)
+            yield self
+        finally:
+            self.in_flight.release()
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["requests_per_second"] = self.requests.rate
+            stats["paused_for"] = max(self.paused_until - time(), 0.0)
+        with self.in_flight.lock:
+            stats["in_flight"] = self.in_flight.in_flight
+            stats["waiting"] = len(self.in_flight.waiters)
+        return stats
+
+
+_limiters = {}
+_limiters_lock = Lock()
+
+
+def get_limiter(name) -> WorkerLimiter:
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = WorkerLimiter.from_env(name)
+        return _limiters[name]
+
+
+def check_rate_limit(worker, status_code, retry_after, body):
+    # Lets the worker's limiter adapt to the response, and raises for 429 so the call can be retried
+    get_limiter(worker).report(status_code, retry_after)
+    if status_code == 429:
+        raise RateLimitedError(f"{worker} worker was rate limited with body: {body}", retry_after)
+
+
+def estimate_tokens(prompt: str, max_tokens: int) -> int:
+    # Roughly 4 characters per token, plus the most the model is allowed to generate
+    return len(prompt) // 4 + max_tokens
@@ -0,0 +1,155 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+from collections import OrderedDict
+from os import environ as env
+from threading import Lock
+from time import time
+
+# A content addressed cache for LLM responses, the same comments and edits come back often.
+# There is a bounded in memory LRU tier, in front of a persistent SQLite tier.
+# Entries expire after RESPONSE_CACHE_TTL seconds, and each tier is evicted by size.
+# Set RESPONSE_CACHE=false to disable it, or RESPONSE_CACHE_PATH="" to keep it in memory only.
+# SQLite calls block, so async callers use get_async() and set_async(), which run them on a thread.
+
+RESPONSE_CACHE = env.get("RESPONSE_CACHE", "true").lower() == "true"
+RESPONSE_CACHE_PATH = env.get("RESPONSE_CACHE_PATH", "response_cache.sqlite")
+RESPONSE_CACHE_TTL = float(env.get("RESPONSE_CACHE_TTL", 7 * 24 * 60 * 60))
+RESPONSE_CACHE_MEMORY_ITEMS = int(env.get("RESPONSE_CACHE_MEMORY_ITEMS", 1000))
+RESPONSE_CACHE_DISK_ITEMS = int(env.get("RESPONSE_CACHE_DISK_ITEMS", 100000))
+# Once the disk tier is over its size, this many extra of the least recently used rows are evicted,
+# so eviction runs once per batch of new rows rather than on every write
+EVICTION_BATCH = max(1, RESPONSE_CACHE_DISK_ITEMS // 100)
+EXPIRY_INTERVAL = 60  # Seconds between deleting expired rows
+
+
+def cache_key(worker, model, temperature, prompt, model_class_name, json_schema) -> str:
+    # The class name and schema are both part of the key, so a changed schema doesn't return stale shapes
+    key_parts = [worker, model, temperature, prompt, model_class_name, json_schema]
+    return hashlib.sha256(json.dumps(key_parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path=RESPONSE_CACHE_PATH, ttl=RESPONSE_CACHE_TTL,
+                 memory_items=RESPONSE_CACHE_MEMORY_ITEMS, disk_items=RESPONSE_CACHE_DISK_ITEMS):
+        self.path = path
+        self.ttl = ttl
+        self.memory_items = memory_items
+        self.disk_items = disk_items
+        self.memory = OrderedDict()  # key -> (expires_at, json_text)
+        self.lock = Lock()
+        self.db = None
+        self.disk_count = 0  # Rows on disk, counted when opened, and kept up to date, roughly, by writes
+        self.expired_at = 0.0  # When expired rows were last deleted
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def get_db(self):
+        if self.db is None and self.path:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            # Eviction reads the least recently used and the expired rows
+            self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS responses_expires_at ON responses (expires_at)")
+            self.db.commit()
+            self.disk_count = self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return self.db
+
+    def get(self, key):
+        now = time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self.memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return json.loads(value)
+                del self.memory[key]
+
+            db = self.get_db()
+            if db is not None:
+                row = db.execute(
+                    "SELECT value, expires_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and row[1] > now:
+                    db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+                    db.commit()
+                    self.remember(key, row[1], row[0])
+                    self.stats["disk_hits"] += 1
+                    return json.loads(row[0])
+
+            self.stats["misses"] += 1
+            return None
+
+    def set(self, key, result):
+        if result is None:
+            return  # Failed calls are not cached
+        now = time()
+        expires_at = now + self.ttl
+        value = json.dumps(result)
+        with self.lock:
+            self.remember(key, expires_at, value)
+            self.stats["stores"] += 1
+            db = self.get_db()
+            if db is not None:
+                db.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                    (key, value, expires_at, now),
+                )
+                self.disk_count += 1  # Over counts replaced keys, it's corrected before evicting
+                if now - self.expired_at > EXPIRY_INTERVAL:
+                    self.expired_at = now
+                    self.disk_count -= db.execute("DELETE FROM responses WHERE expires_at <= ?", (now,)).rowcount
+                if self.disk_count > self.disk_items:
+                    self.evict(db)
+                db.commit()
+
+    def evict(self, db):
+        # Caller holds the lock
+        self.disk_count = db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if self.disk_count <= self.disk_items:
+            return
+        evicted = db.execute(
+            "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at LIMIT ?)",
+            (self.disk_count - self.disk_items + EVICTION_BATCH,),
+        ).rowcount
+        self.disk_count -= evicted
+        self.stats["evictions"] += evicted
+
+    async def get_async(self, key):
+        return await asyncio.to_thread(self.get, key)
+
+    async def set_async(self, key, result):
+        await asyncio.to_thread(self.set, key, result)
+
+    def remember(self, key, expires_at, value):
+        # Caller holds the lock
+        self.memory[key] = (expires_at, value)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            db = self.get_db()
+            if db is not None:
+                db.execute("DELETE FROM responses")
+                db.commit()
+                self.disk_count = 0
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["memory_items"] = len(self.memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+
+response_cache = ResponseCache()
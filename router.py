@@ -0,0 +1,184 @@
+import asyncio
+import random
+from collections import deque
+from os import environ as env
+from threading import Lock
+from time import time
+from call_metrics import record_hedge, record_retry
+from stats import LATENCY_WINDOW, percentile
+
+# Routing of LLM calls across workers, above the individual worker functions.
+# Failed calls are retried with exponential backoff and full jitter, moving on to the next worker in
+# LLM_FALLBACK_WORKERS (a comma separated list, e.g: "mistral,anthropic") if there is one.
+# Calls are also hedged: when the first worker takes longer than its own p95 latency,
+# the same request is sent to a fallback worker too, and whichever answers first is used.
+# Each worker's latency percentiles and error rate are tracked, a worker with a high recent error rate
+# is tried after the healthy ones.
+
+LLM_FALLBACK_WORKERS = [name.strip() for name in env.get("LLM_FALLBACK_WORKERS", "").split(",") if name.strip()]
+LLM_RETRIES = int(env.get("LLM_RETRIES", 3))
+RETRY_BACKOFF_BASE = float(env.get("RETRY_BACKOFF_BASE", 0.5))
+RETRY_BACKOFF_MAX = float(env.get("RETRY_BACKOFF_MAX", 8))
+HEDGE_REQUESTS = env.get("HEDGE_REQUESTS", "true").lower() == "true"
+HEDGE_MIN_SAMPLES = int(env.get("HEDGE_MIN_SAMPLES", 20))  # Successful calls needed before a worker's p95 is trusted
+HEDGE_MIN_DELAY = float(env.get("HEDGE_MIN_DELAY", 0.5))
+MAX_ERROR_RATE = float(env.get("MAX_ERROR_RATE", 0.5))
+OUTCOME_WINDOW = 50
+
+JSON_REMINDER = " You must output the JSON in the required format only, with no remarks or prefacing remarks - JUST JSON!"
+
+
+class InvalidOutputError(ValueError):
+    """The worker answered, but not with JSON matching the model class, so it's retried with a reminder."""
+    pass
+
+
+def backoff_delay(attempt):
+    # Full jitter, so retries from concurrent calls don't all land together
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** attempt))
+
+
+class WorkerStats:
+    def __init__(self):
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.outcomes = deque(maxlen=OUTCOME_WINDOW)  # True for success
+        self.counts = {"requests": 0, "errors": 0, "retries": 0, "hedges": 0, "hedge_wins": 0}
+
+    def error_rate(self):
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def p50(self):
+        return percentile(list(self.latencies), 0.5)
+
+    def p95(self):
+        return percentile(list(self.latencies), 0.95)
+
+
+class Router:
+    def __init__(self):
+        self.stats = {}
+        self.lock = Lock()
+
+    def worker_stats(self, name) -> WorkerStats:
+        with self.lock:
+            if name not in self.stats:
+                self.stats[name] = WorkerStats()
+            return self.stats[name]
+
+    def record(self, name, seconds, error=None):
+        stats = self.worker_stats(name)
+        with self.lock:
+            stats.counts["requests"] += 1
+            stats.outcomes.append(error is None)
+            if error is None:
+                stats.latencies.append(seconds)
+            else:
+                stats.counts["errors"] += 1
+
+    def count(self, name, counter):
+        stats = self.worker_stats(name)
+        with self.lock:
+            stats.counts[counter] += 1
+
+    def order(self, candidates):
+        """Keeps the preferred worker first unless it's failing, with fallbacks ordered by median latency."""
+        preferred, fallbacks = candidates[0], candidates[1:]
+        fallbacks = sorted(fallbacks, key=lambda worker: self.worker_stats(worker.name).p50() or 0.0)
+        ordered = [preferred] + fallbacks
+        healthy = [worker for worker in ordered if self.worker_stats(worker.name).error_rate() <= MAX_ERROR_RATE]
+        return healthy + [worker for worker in ordered if worker not in healthy]
+
+    def hedge_delay(self, worker):
+        stats = self.worker_stats(worker.name)
+        if len(stats.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(stats.p95(), HEDGE_MIN_DELAY)
+
+    async def call_async(self, candidates, prompt, model_class):
+        """Calls the first worker, retrying with backoff on the next ones, and hedging slow calls,
+        returns the result and the worker used."""
+        candidates = self.order(candidates)
+        retry_prompt = prompt
+        for attempt in range(LLM_RETRIES + 1):
+            worker = candidates[attempt % len(candidates)]
+            hedge_worker = candidates[(attempt + 1) % len(candidates)] if len(candidates) > 1 else None
+            try:
+                return await self.hedged_call(worker, hedge_worker, retry_prompt, model_class)
+            except Exception as e:
+                if attempt == LLM_RETRIES:
+                    raise
+                retry_prompt = self.prompt_for_retry(prompt, e)
+                delay = backoff_delay(attempt)
+                self.count(worker.name, "retries")
+                record_retry()
+                print(f"{worker.name} worker call failed, retrying in {delay:.2f} seconds: {e}")
+                await asyncio.sleep(delay)
+
+    def prompt_for_retry(self, prompt, error):
+        # Rate limits and network errors are retried as they were, invalid output gets a reminder
+        return prompt + JSON_REMINDER if isinstance(error, InvalidOutputError) else prompt
+
+    async def timed_call(self, worker, prompt, model_class):
+        start_time = time()
+        try:
+            if not worker.initialised:
+                await asyncio.to_thread(worker.warmup)
+            result = await worker.call_async(prompt, model_class)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.record(worker.name, time() - start_time, e)
+            raise
+        self.record(worker.name, time() - start_time)
+        return result, worker
+
+    async def hedged_call(self, worker, hedge_worker, prompt, model_class):
+        delay = self.hedge_delay(worker) if HEDGE_REQUESTS and hedge_worker is not None else None
+        if delay is None:
+            return await self.timed_call(worker, prompt, model_class)
+
+        first = asyncio.ensure_future(self.timed_call(worker, prompt, model_class))
+        pending = {first}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return first.result()
+
+            print(f"{worker.name} worker is slower than its p95 of {delay:.2f} seconds, hedging with {hedge_worker.name}")
+            self.count(worker.name, "hedges")
+            record_hedge()
+            hedge = asyncio.ensure_future(self.timed_call(hedge_worker, prompt, model_class))
+            pending = {first, hedge}
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.count(worker.name, "hedge_wins")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # The slower request is abandoned, and cancelled too if this call itself is cancelled
+            for task in pending:
+                task.cancel()
+
+    def get_stats(self):
+        """Returns request counts, error rate and p50/p95 latency for each worker used."""
+        stats = {}
+        with self.lock:
+            names = list(self.stats)
+        for name in names:
+            worker_stats = self.worker_stats(name)
+            with self.lock:
+                stats[name] = dict(
+                    worker_stats.counts,
+                    error_rate=worker_stats.error_rate(),
+                    p50_seconds=worker_stats.p50(),
+                    p95_seconds=worker_stats.p95(),
+                )
+        return stats
+
+
+router = Router()
@@ -0,0 +1,140 @@
+import asyncio
+import json
+from os import environ as env
+from time import sleep, time
+import http_pool
+from rate_limit import check_rate_limit
+
+# RunPod serverless job client.
+# /runsync only waits about 30 seconds before returning a job ID instead of the output,
+# so jobs are submitted with /run, then /status is polled with a growing interval until the job finishes.
+# If a job times out, or the awaiting task is cancelled (e.g: by a deadline), the job is cancelled on RunPod too.
+
+RUNPOD_POLL_INTERVAL = float(env.get("RUNPOD_POLL_INTERVAL", 0.25))
+RUNPOD_MAX_POLL_INTERVAL = float(env.get("RUNPOD_MAX_POLL_INTERVAL", 5))
+RUNPOD_POLL_BACKOFF = 1.5
+RUNPOD_JOB_TIMEOUT = float(env.get("RUNPOD_JOB_TIMEOUT", 300))
+RUNPOD_API_URL = env.get("RUNPOD_API_URL", "https://api.runpod.ai/v2")
+
+FINISHED_STATUSES = ["COMPLETED", "FAILED", "CANCELLED", "TIMED_OUT"]
+
+
+class RunPodJobError(ValueError):
+    pass
+
+
+def runpod_endpoint():
+    RUNPOD_ENDPOINT_ID = env.get("RUNPOD_ENDPOINT_ID")
+    RUNPOD_API_KEY = env.get("RUNPOD_API_KEY")
+    assert RUNPOD_ENDPOINT_ID, "RUNPOD_ENDPOINT_ID environment variable not set"
+    assert RUNPOD_API_KEY, "RUNPOD_API_KEY environment variable not set"
+    base_url = f"{RUNPOD_API_URL}/{RUNPOD_ENDPOINT_ID}"
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': f'Bearer {RUNPOD_API_KEY}'
+    }
+    return base_url, headers
+
+
+def check_response(status_code, body):
+    check_rate_limit("runpod", status_code, None, body)
+    if status_code != 200:
+        raise RunPodJobError(f"Unexpected RunPod API status code: {status_code} with body: {body}")
+    return json.loads(body)
+
+
+def job_result(job):
+    # Returns the finished job, or raises if it didn't complete
+    if job["status"] != "COMPLETED":
+        raise RunPodJobError(f"RunPod job {job.get('id')} finished with status {job['status']}: {job.get('error')}")
+    return job
+
+
+def next_poll_interval(interval, deadline):
+    return min(interval * RUNPOD_POLL_BACKOFF, RUNPOD_MAX_POLL_INTERVAL, max(deadline - time(), 0))
+
+
+def submit_job(job_input):
+    base_url, headers = runpod_endpoint()
+    response = http_pool.post(f"{base_url}/run", json={"input": job_input}, headers=headers)
+    return check_response(response.status_code, response.text)
+
+
+def job_status(job_id):
+    base_url, headers = runpod_endpoint()
+    response = http_pool.get(f"{base_url}/status/{job_id}", headers=headers)
+    return check_response(response.status_code, response.text)
+
+
+def cancel_job(job_id):
+    base_url, headers = runpod_endpoint()
+    try:
+        response = http_pool.post(f"{base_url}/cancel/{job_id}", headers=headers)
+        print(f"Cancelled RunPod job {job_id}: {response.status_code}")
+    except Exception as e:
+        print(f"Error cancelling RunPod job {job_id}: {e}")
+
+
+def run_job(job_input, timeout=RUNPOD_JOB_TIMEOUT):
+    """Submits a job, polls until it finishes, and returns the completed job with its "output"."""
+    deadline = time() + timeout
+    job = submit_job(job_input)
+    interval = RUNPOD_POLL_INTERVAL
+    try:
+        while job["status"] not in FINISHED_STATUSES:
+            if time() >= deadline:
+                raise TimeoutError(f"RunPod job {job['id']} did not finish within {timeout} seconds")
+            sleep(interval)
+            interval = next_poll_interval(interval, deadline)
+            job = job_status(job["id"])
+    except BaseException:
+        cancel_job(job["id"])
+        raise
+    return job_result(job)
+
+
+async def submit_job_async(job_input):
+    base_url, headers = runpod_endpoint()
+    async with http_pool.async_post(f"{base_url}/run", json={"input": job_input}, headers=headers) as response:
+        return check_response(response.status, await response.text())
+
+
+async def job_status_async(job_id):
+    base_url, headers = runpod_endpoint()
+    async with http_pool.async_get(f"{base_url}/status/{job_id}", headers=headers) as response:
+        return check_response(response.status, await response.text())
+
+
+async def cancel_job_async(job_id):
+    base_url, headers = runpod_endpoint()
+    try:
+        async with http_pool.async_post(f"{base_url}/cancel/{job_id}", headers=headers) as response:
+            print(f"Cancelled RunPod job {job_id}: {response.status}")
+    except Exception as e:
+        print(f"Error cancelling RunPod job {job_id}: {e}")
+
+
+async def run_job_async(job_input, timeout=RUNPOD_JOB_TIMEOUT):
+    deadline = time() + timeout
+    job = await submit_job_async(job_input)
+    interval = RUNPOD_POLL_INTERVAL
+    try:
+        while job["status"] not in FINISHED_STATUSES:
+            if time() >= deadline:
+                raise TimeoutError(f"RunPod job {job['id']} did not finish within {timeout} seconds")
+            await asyncio.sleep(interval)
+            interval = next_poll_interval(interval, deadline)
+            job = await job_status_async(job["id"])
+    except BaseException:
+        # Shielded, so the cancel request is still sent when this task itself is being cancelled
+        await asyncio.shield(cancel_job_async(job["id"]))
+        raise
+    return job_result(job)
+
+
+async def run_jobs_async(job_inputs, timeout=RUNPOD_JOB_TIMEOUT):
+    """Runs a batch of jobs concurrently, returning results in order, with exceptions in place of failed jobs."""
+    return await asyncio.gather(
+        *[run_job_async(job_input, timeout=timeout) for job_input in job_inputs],
+        return_exceptions=True,
+    )
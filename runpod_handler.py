@@ -21,7 +21,10 @@ def pydantic_model_to_json_schema(pydantic_model_class):
 default_schema_example = """{ "title": ..., "year": ..., "director": ..., "genre": ..., "plot":...}"""
 default_schema = pydantic_model_to_json_schema(Movie)
 default_prompt = f"Instruct: \nOutput a JSON object in this format: {default_schema_example} for the following movie: The Matrix\nOutput:\n"
-from utils import llm_stream_sans_network_simple
+from utils import llm_stream_sans_network_simple, get_llama_grammar, sampling_at, warmup
+# Load the model and compile the default grammar at worker start-up, later jobs with the same schema string reuse cached grammars
+warmup("in_memory")
+get_llama_grammar(default_schema)
 def handler(job):
     """ Handler function that will be used to process jobs. """
     job_input = job['input']
@@ -31,7 +34,9 @@ def handler(job):
     print("got this input", str(job_input))
     print("prompt", prompt )
     print("schema", schema )
-    output = llm_stream_sans_network_simple(prompt, schema)
+    # Set by callers sampling several varied answers, the schema's default temperature is used otherwise
+    with sampling_at(job_input.get('temperature')):
+        output = llm_stream_sans_network_simple(prompt, schema)
     #print("got this output", str(output))
     return output
     
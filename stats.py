@@ -0,0 +1,11 @@
+# Rolling latency stats shared by the endpoint pool, router, scheduler, toxicity batcher and benchmark.
+
+LATENCY_WINDOW = 200  # Number of recent latencies kept for percentiles
+
+
+def percentile(values, fraction):
+    # Nearest rank, e.g: fraction 0.95 for the p95, None if there are no values yet
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
@@ -0,0 +1,134 @@
+import json
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# An incremental JSON object parser for streamed LLM output.
+# Tokens are fed in as they arrive, it detects when the top level object is closed,
+# so the stream can be stopped there instead of waiting for the model to stop generating.
+# Top level fields, like "hybrid", can be read while they are still being written.
+
+# A callback that gets the partial top level fields as a dict each time more output arrives.
+# Set it with listen_partial_output(), it is inherited by tasks and threads started with asyncio.to_thread.
+partial_output_listener = ContextVar("partial_output_listener", default=None)
+
+
+@contextmanager
+def listen_partial_output(callback):
+    token = partial_output_listener.set(callback)
+    try:
+        yield
+    finally:
+        partial_output_listener.reset(token)
+
+
+def decode_partial_string(raw):
+    # raw is an unterminated JSON string without its opening quote, it may end part way through an escape
+    for trim in range(0, 6):
+        try:
+            return json.loads('"' + raw[:len(raw) - trim] + '"')
+        except ValueError:
+            continue
+    return None
+
+
+class StreamingJSONParser:
+    def __init__(self):
+        self.chunks = []
+        self.started = False
+        self.complete = False
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.mode = None  # None, "key" or "value", for what is being read at the top level
+        self.key_chars = []
+        self.current_key = None
+        self.raw_values = {}  # Top level key -> list of raw JSON characters of its value so far
+
+    def feed(self, text: str) -> bool:
+        """Consumes more output, returns True once the top level object is complete."""
+        if self.complete:
+            return True
+        start = None
+        for index, char in enumerate(text):
+            if not self.started:
+                if char == "{":
+                    self.started = True
+                    self.depth = 1
+                    start = index
+                continue
+            if start is None:
+                start = index
+            self.read_char(char)
+            if self.complete:
+                self.chunks.append(text[start:index + 1])
+                return True
+        if start is not None:
+            self.chunks.append(text[start:])
+        return False
+
+    def read_char(self, char):
+        if self.in_string:
+            if self.escaped:
+                self.escaped = False
+            elif char == "\\":
+                self.escaped = True
+            elif char == '"':
+                self.in_string = False
+                if self.mode == "key":
+                    self.current_key = json.loads('"' + "".join(self.key_chars) + '"')
+                    self.mode = None
+                    return
+            if self.mode == "key":
+                self.key_chars.append(char)
+            elif self.mode == "value":
+                self.raw_values[self.current_key].append(char)
+            return
+
+        if char == '"':
+            self.in_string = True
+            if self.depth == 1 and self.mode is None:
+                self.mode = "key"
+                self.key_chars = []
+                return
+        elif char in "{[":
+            self.depth += 1
+        elif char in "}]":
+            self.depth -= 1
+            if self.depth == 0:
+                self.complete = True
+                self.mode = None
+                return
+        elif self.depth == 1 and char == ":":
+            self.mode = "value"
+            self.raw_values[self.current_key] = []
+            return
+        elif self.depth == 1 and char == ",":
+            self.mode = None
+            return
+        if self.mode == "value":
+            self.raw_values[self.current_key].append(char)
+
+    def text(self) -> str:
+        return "".join(self.chunks)
+
+    def partial_fields(self) -> dict:
+        """Returns the top level fields seen so far, with unfinished strings decoded as far as they go."""
+        fields = {}
+        for key, chars in self.raw_values.items():
+            raw = "".join(chars).strip()
+            if not raw:
+                continue
+            try:
+                fields[key] = json.loads(raw)
+            except ValueError:
+                if raw.startswith('"'):
+                    partial = decode_partial_string(raw[1:])
+                    if partial is not None:
+                        fields[key] = partial
+        return fields
+
+
+def notify_partial_output(parser):
+    listener = partial_output_listener.get()
+    if listener is not None:
+        listener(parser.partial_fields())
@@ -0,0 +1,236 @@
+from argparse import ArgumentParser
+import json
+import random
+import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from threading import Lock, Thread
+from time import sleep, time
+from promptObjects import FaithfulnessScore, Critique, ImprovedText, Judgement, SpicyScore
+
+# A stand-in LLM server for benchmarking without a model, an API key or a network.
+# It answers like each of the workers' backends:
+# - POST /v1/chat/completions with "stream": true, as server sent events, like the llama.cpp server (http worker)
+# - POST /v1/chat/completions without streaming, like the Mistral API
+# - POST /v1/messages, like the Anthropic API
+# - POST /<endpoint>/run, GET /<endpoint>/status/<id> and POST /<endpoint>/cancel/<id>, like RunPod
+# - GET /health
+# Outputs are valid JSON for the prompt's model class, with configurable latency, token rate and injected errors.
+# Run it on its own with: python3 stub_llm_server.py --port 5834 --latency 0.2 --tokens-per-second 50
+# or start it in process with start_stub_server(), as benchmark.py does.
+
+# Model classes the stub can answer for, the one whose fields all appear in the prompt, with the most fields, is used
+MODEL_CLASSES = [Judgement, ImprovedText, Critique, FaithfulnessScore, SpicyScore]
+CHARS_PER_TOKEN = 4
+
+
+class StubConfig:
+    def __init__(self, latency=0.1, tokens_per_second=100.0, error_rate=0.0, rate_limit_rate=0.0, seed=None):
+        self.latency = latency  # Seconds before the first token
+        self.tokens_per_second = tokens_per_second  # 0 sends everything at once
+        self.error_rate = error_rate  # Fraction of requests answered with a 500
+        self.rate_limit_rate = rate_limit_rate  # Fraction of requests answered with a 429
+        self.random = random.Random(seed)
+        self.lock = Lock()
+
+    def roll(self):
+        with self.lock:
+            return self.random.random()
+
+    def uniform(self, low, high):
+        with self.lock:
+            return round(self.random.uniform(low, high), 2)
+
+
+def quoted_texts(prompt):
+    # The templates quote the original text and the edit in backticks
+    return re.findall(r"`([^`]*)`", prompt)
+
+
+def model_class_for(prompt):
+    matches = [cls for cls in MODEL_CLASSES if all(field in prompt for field in cls.model_fields)]
+    return max(matches, key=lambda cls: len(cls.model_fields)) if matches else Critique
+
+
+def fake_value(name, field_schema, config, text):
+    field_type = field_schema.get("type")
+    if field_type == "array":
+        return text.split()[:3] or ["example"]
+    if field_type in ["number", "integer"]:
+        if "spicy" in name:
+            return config.uniform(0.0, 0.4)
+        if field_type == "integer":
+            return int(config.uniform(1, 100))
+        return config.uniform(0.6, 1.0)
+    if field_type == "boolean":
+        return config.roll() > 0.5
+    if name == "critique":
+        return "This is calmer, and keeps most of the original intent."
+    return text
+
+
+def fake_output(prompt, config, schema=None):
+    """Returns JSON text that is valid for the prompt's model class, or for the JSON schema string if given."""
+    schema = json.loads(schema) if schema else model_class_for(prompt).model_json_schema()
+    texts = quoted_texts(prompt)
+    # The edit is as long as the original text, so output length grows with the input like a real model's
+    text = texts[0].strip('"') if texts else "A calmer version of the text."
+    output = {
+        name: fake_value(name, field_schema, config, text)
+        for name, field_schema in schema.get("properties", {}).items()
+    }
+    return json.dumps(output)
+
+
+def token_chunks(text):
+    return [text[index:index + CHARS_PER_TOKEN] for index in range(0, len(text), CHARS_PER_TOKEN)]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = StubConfig()
+    jobs = {}  # RunPod job ID -> (finishes_at, output)
+    job_ids = count(1)
+    jobs_lock = Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The client cancelled the call, e.g: at its deadline
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def injected_error(self):
+        # Returns True if an error response was sent instead of a normal one
+        roll = self.config.roll()
+        if roll < self.config.rate_limit_rate:
+            self.send_json(429, {"error": "stub rate limit"}, {"Retry-After": "0.5"})
+            return True
+        if roll < self.config.rate_limit_rate + self.config.error_rate:
+            self.send_json(500, {"error": "stub error"})
+            return True
+        return False
+
+    def generation_seconds(self, output):
+        if self.config.tokens_per_second <= 0:
+            return 0.0
+        return len(token_chunks(output)) / self.config.tokens_per_second
+
+    def do_GET(self):
+        if self.path == "/health":
+            return self.send_json(200, {"status": "ok"})
+        if "/status/" in self.path:
+            return self.runpod_status(self.path.rsplit("/", 1)[1])
+        self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        body = self.read_json()
+        if self.path.endswith("/run"):
+            return self.runpod_run(body)
+        if "/cancel/" in self.path:
+            return self.send_json(200, {"status": "CANCELLED"})
+        if self.injected_error():
+            return
+        if self.path.endswith("/messages"):
+            return self.anthropic(body)
+        if self.path.endswith("/chat/completions"):
+            return self.chat_completions_stream(body) if body.get("stream") else self.chat_completions(body)
+        self.send_json(404, {"error": "not found"})
+
+    def chat_completions_stream(self, body):
+        output = fake_output(body["messages"][-1]["content"], self.config)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        sleep(self.config.latency)
+        delay = 1 / self.config.tokens_per_second if self.config.tokens_per_second > 0 else 0
+        try:
+            for token in token_chunks(output) + [None]:
+                if token is None:
+                    event = "data: [DONE]\n\n"
+                else:
+                    event = "data: " + json.dumps({"choices": [{"delta": {"content": token}}]}) + "\n\n"
+                data = event.encode("utf-8")
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+                if delay:
+                    sleep(delay)
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The client stopped reading once its JSON was complete
+
+    def chat_completions(self, body):
+        prompt = body["messages"][-1]["content"]
+        output = fake_output(prompt, self.config)
+        sleep(self.config.latency + self.generation_seconds(output))
+        usage = {"prompt_tokens": len(prompt) // CHARS_PER_TOKEN, "completion_tokens": len(token_chunks(output))}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        self.send_json(200, {"choices": [{"message": {"role": "assistant", "content": output}}], "usage": usage})
+
+    def anthropic(self, body):
+        prompt = body["messages"][-1]["content"]
+        output = fake_output(prompt, self.config)
+        sleep(self.config.latency + self.generation_seconds(output))
+        usage = {"input_tokens": len(prompt) // CHARS_PER_TOKEN, "output_tokens": len(token_chunks(output))}
+        self.send_json(200, {"content": [{"type": "text", "text": output}], "usage": usage})
+
+    def runpod_run(self, body):
+        job_input = body.get("input", {})
+        output = fake_output(job_input.get("prompt", ""), self.config, job_input.get("schema"))
+        with self.jobs_lock:
+            job_id = f"stub-{next(self.job_ids)}"
+            self.jobs[job_id] = (time() + self.config.latency + self.generation_seconds(output), output)
+        self.send_json(200, {"id": job_id, "status": "IN_QUEUE"})
+
+    def runpod_status(self, job_id):
+        with self.jobs_lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            return self.send_json(404, {"error": f"unknown job {job_id}"})
+        finishes_at, output = job
+        if time() < finishes_at:
+            return self.send_json(200, {"id": job_id, "status": "IN_PROGRESS"})
+        self.send_json(200, {"id": job_id, "status": "COMPLETED", "output": output})
+
+
+def start_stub_server(config=None, port=0, host="127.0.0.1"):
+    """Starts the stub on a background thread, returns the server, its URL is http://host:server.server_port"""
+    handler = type("ConfiguredStubHandler", (StubHandler,), {"config": config or StubConfig(), "jobs": {}})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True, name="stub-llm-server").start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Run a stub LLM server for offline benchmarks.")
+    parser.add_argument("--port", type=int, default=5834)
+    parser.add_argument("--latency", type=float, default=0.1, help="Seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=100.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of requests answered with a 429")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    config = StubConfig(args.latency, args.tokens_per_second, args.error_rate, args.rate_limit_rate, args.seed)
+    server = start_stub_server(config, port=args.port, host="0.0.0.0")
+    print(f"Stub LLM server listening on port {server.server_port}")
+    try:
+        while True:
+            sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,119 @@
+import asyncio
+from threading import Thread
+from time import sleep
+from rate_limit import InFlightLimiter, TokenBucket
+
+# Behaviour checks for the token buckets and the in flight limiter, run with: python -m pytest test_rate_limit.py
+
+
+def test_token_bucket_goes_into_debt():
+    bucket = TokenBucket(10, capacity=2)
+    assert bucket.reserve() == 0.0
+    assert bucket.reserve() == 0.0
+    # Empty, the next request waits for its token to refill at 10 per second
+    assert 0.05 < bucket.reserve() <= 0.1
+    assert 0.15 < bucket.reserve() <= 0.2
+
+
+def test_token_bucket_refund():
+    bucket = TokenBucket(1, capacity=100)
+    assert bucket.reserve(100) == 0.0
+    bucket.refund(60)
+    assert bucket.reserve(50) == 0.0
+
+
+def test_token_bucket_without_a_rate_never_waits():
+    bucket = TokenBucket(0)
+    assert all(bucket.reserve(1000) == 0.0 for _ in range(10))
+
+
+def test_thread_hand_off():
+    limiter = InFlightLimiter(1)
+    limiter.acquire()
+    acquired = []
+    thread = Thread(target=lambda: acquired.append(limiter.acquire() or True))
+    thread.start()
+    sleep(0.05)
+    assert not acquired and len(limiter.waiters) == 1
+    # The slot goes straight to the waiting thread, it's never free in between
+    limiter.release()
+    thread.join(1)
+    assert acquired == [True]
+    assert limiter.in_flight == 1
+    limiter.release()
+    assert limiter.in_flight == 0
+
+
+def test_async_hand_off_is_first_in_first_out():
+    async def run():
+        limiter = InFlightLimiter(1)
+        await limiter.acquire_async()
+        order = []
+
+        async def waiter(name):
+            await limiter.acquire_async()
+            order.append(name)
+            await asyncio.sleep(0.01)
+            limiter.release()
+
+        tasks = [asyncio.ensure_future(waiter(name)) for name in ("first", "second", "third")]
+        await asyncio.sleep(0.01)
+        assert len(limiter.waiters) == 3
+        limiter.release()
+        await asyncio.gather(*tasks)
+        assert order == ["first", "second", "third"]
+        assert limiter.in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiter_passes_its_slot_on():
+    async def run():
+        limiter = InFlightLimiter(1)
+        await limiter.acquire_async()
+        cancelled = asyncio.ensure_future(limiter.acquire_async())
+        later = asyncio.ensure_future(limiter.acquire_async())
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        await asyncio.sleep(0.01)
+        limiter.release()
+        await asyncio.wait_for(later, 1)
+        assert limiter.in_flight == 1
+        limiter.release()
+        assert limiter.in_flight == 0 and not limiter.waiters
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiter_with_no_one_behind_frees_its_slot():
+    async def run():
+        limiter = InFlightLimiter(1)
+        await limiter.acquire_async()
+        cancelled = asyncio.ensure_future(limiter.acquire_async())
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        limiter.release()
+        await asyncio.sleep(0.01)
+        assert limiter.in_flight == 0 and not limiter.waiters
+
+    asyncio.run(run())
+
+
+def test_waiter_cancelled_after_the_hand_off_releases_the_slot():
+    async def run():
+        limiter = InFlightLimiter(1)
+        await limiter.acquire_async()
+        waiting = asyncio.ensure_future(limiter.acquire_async())
+        await asyncio.sleep(0.01)
+        limiter.release()
+        await asyncio.sleep(0)  # The slot is handed over, but the task hasn't resumed yet
+        waiting.cancel()
+        try:
+            await waiting
+        except asyncio.CancelledError:
+            pass
+        await asyncio.sleep(0.01)
+        assert waiting.cancelled()
+        assert limiter.in_flight == 0 and not limiter.waiters
+
+    asyncio.run(run())
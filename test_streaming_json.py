@@ -0,0 +1,74 @@
+import json
+from streaming_json import StreamingJSONParser, listen_partial_output, notify_partial_output
+
+# Behaviour checks for the incremental parser, run with: python -m pytest test_streaming_json.py
+
+
+def feed_tokens(text, size):
+    # Feeds text in chunks of size characters, like streamed tokens, returning the parser and whether it completed
+    parser = StreamingJSONParser()
+    done = False
+    for index in range(0, len(text), size):
+        done = parser.feed(text[index:index + size])
+    return parser, done
+
+
+def test_braces_and_brackets_inside_strings_are_not_structure():
+    output = '{"hybrid": "a } or ] or { here", "worst_terms": ["[x]", "}"]}'
+    for size in (1, 3, len(output)):
+        parser, done = feed_tokens(output, size)
+        assert done
+        assert json.loads(parser.text()) == json.loads(output)
+
+
+def test_escaped_quotes_and_backslashes():
+    output = json.dumps({"hybrid": 'say "hi" \\ then } "{"', "nvc": "\\"})
+    for size in (1, 2, 5):
+        parser, done = feed_tokens(output, size)
+        assert done
+        assert json.loads(parser.text()) == json.loads(output)
+
+
+def test_prose_before_the_object_is_skipped():
+    parser = StreamingJSONParser()
+    assert not parser.feed("Sure! Here is the JSON you asked for:\n")
+    assert not parser.started
+    assert parser.feed('{"spicy_score": 0.5}')
+    assert parser.text() == '{"spicy_score": 0.5}'
+
+
+def test_trailing_output_is_dropped():
+    parser = StreamingJSONParser()
+    assert parser.feed('{"spicy_score": 0.5} and some notes')
+    assert parser.feed(" more notes, and another {")
+    assert parser.text() == '{"spicy_score": 0.5}'
+
+
+def test_incomplete_object_is_not_complete():
+    parser, done = feed_tokens('{"hybrid": "not finished", "nested": {"a": 1}', 4)
+    assert not done
+    assert not parser.complete
+
+
+def test_partial_fields_while_streaming():
+    parser = StreamingJSONParser()
+    parser.feed('{"worst_terms": ["idiot"], "hybrid": "You are \\"mist')
+    assert parser.partial_fields() == {"worst_terms": ["idiot"], "hybrid": 'You are "mist'}
+
+
+def test_partial_fields_with_a_split_escape():
+    parser = StreamingJSONParser()
+    parser.feed('{"hybrid": "caf\\u00')
+    assert parser.partial_fields() == {"hybrid": "caf"}
+    parser.feed('e9 time"}')
+    assert parser.partial_fields() == {"hybrid": "café time"}
+
+
+def test_listener_gets_partial_fields():
+    seen = []
+    parser = StreamingJSONParser()
+    parser.feed('{"hybrid": "Calm')
+    with listen_partial_output(seen.append):
+        notify_partial_output(parser)
+    notify_partial_output(parser)  # No listener outside the block
+    assert seen == [{"hybrid": "Calm"}]
@@ -0,0 +1,131 @@
+import asyncio
+from collections import deque
+from concurrent.futures import Future
+from os import environ as env
+from threading import Condition, Lock, Thread
+from time import time
+from typing import List
+from stats import LATENCY_WINDOW, percentile
+
+# Cheap local toxicity scores from a Detoxify model, used to find the parts of a text worth sending to the LLM,
+# and to skip the LLM entirely for input that is already calm (CALM_THRESHOLD).
+# Scores are Detoxify's "toxicity" probability, from 0 (calm) to 1.
+# Needs: pip install detoxify
+# The model is loaded on first use, like the in memory LLM, so importing this module is free.
+# Texts scored at about the same time, e.g: by concurrent requests, are batched into one model call
+# on a scoring thread, which is much faster per text than scoring them one by one.
+
+TOXICITY_MODEL = env.get("TOXICITY_MODEL", "original-small")  # Also: "unbiased-small", "original", "unbiased"
+TOXICITY_DEVICE = env.get("TOXICITY_DEVICE", "cpu")
+# Input scored under this is returned as it is, without any LLM calls, 0 turns the check off
+CALM_THRESHOLD = float(env.get("CALM_THRESHOLD", 0))
+TOXICITY_BATCH_SIZE = int(env.get("TOXICITY_BATCH_SIZE", 32))
+TOXICITY_BATCH_WAIT = float(env.get("TOXICITY_BATCH_WAIT", 0.005))  # Seconds to wait for more texts to batch with
+
+toxicity_model = None
+toxicity_model_lock = Lock()
+# Torch models aren't safe to call from several threads at once
+toxicity_predict_lock = Lock()
+
+
+def load_toxicity_model():
+    global toxicity_model
+    with toxicity_model_lock:
+        if toxicity_model is None:
+            from detoxify import Detoxify
+            print(f"Loading {TOXICITY_MODEL} Detoxify model")
+            toxicity_model = Detoxify(TOXICITY_MODEL, device=TOXICITY_DEVICE)
+    return toxicity_model
+
+
+def toxicity_scores(texts: List[str]) -> List[float]:
+    """Scores a list of texts in one batch, returning a toxicity score for each."""
+    if not texts:
+        return []
+    model = load_toxicity_model()
+    with toxicity_predict_lock:
+        predictions = model.predict(list(texts))
+    return [float(score) for score in predictions["toxicity"]]
+
+
+class ToxicityBatcher:
+    def __init__(self, batch_size=TOXICITY_BATCH_SIZE, batch_wait=TOXICITY_BATCH_WAIT):
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.pending = deque()  # (text, future, submitted_at)
+        self.condition = Condition()
+        self.thread = None
+        self.latencies = deque(maxlen=LATENCY_WINDOW)  # Seconds from submitting a text to its score
+        self.batch_seconds = deque(maxlen=LATENCY_WINDOW)  # Model time per batch
+        self.stats = {"texts": 0, "batches": 0, "failed_batches": 0}
+
+    def submit(self, texts) -> List[Future]:
+        """Queues texts for scoring, returning a Future for each text's score."""
+        futures = [Future() for _ in texts]
+        with self.condition:
+            now = time()
+            self.pending.extend((text, future, now) for text, future in zip(texts, futures))
+            if self.thread is None:
+                self.thread = Thread(target=self.loop, daemon=True, name="toxicity-batcher")
+                self.thread.start()
+            self.condition.notify()
+        return futures
+
+    def next_batch(self):
+        with self.condition:
+            while not self.pending:
+                self.condition.wait()
+            # Wait a moment for more texts to share the batch, unless it's full already
+            wait_until = time() + self.batch_wait
+            while len(self.pending) < self.batch_size and time() < wait_until:
+                self.condition.wait(wait_until - time())
+            return [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+
+    def loop(self):
+        while True:
+            batch = [job for job in self.next_batch() if job[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            start_time = time()
+            try:
+                scores = toxicity_scores([text for text, _, _ in batch])
+            except BaseException as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                with self.condition:
+                    self.stats["failed_batches"] += 1
+                continue
+            finished_at = time()
+            for (_, future, submitted_at), score in zip(batch, scores):
+                future.set_result(score)
+            with self.condition:
+                self.stats["texts"] += len(batch)
+                self.stats["batches"] += 1
+                self.batch_seconds.append(finished_at - start_time)
+                self.latencies.extend(finished_at - submitted_at for _, _, submitted_at in batch)
+
+    def get_stats(self):
+        """Returns text and batch counts, and latency percentiles of scoring a text, and of each batch."""
+        with self.condition:
+            stats = dict(self.stats)
+            stats["queued"] = len(self.pending)
+            latencies = list(self.latencies)
+            batch_seconds = list(self.batch_seconds)
+        stats["mean_batch_size"] = round(stats["texts"] / stats["batches"], 2) if stats["batches"] else None
+        stats["latency_p50_seconds"] = percentile(latencies, 0.5)
+        stats["latency_p95_seconds"] = percentile(latencies, 0.95)
+        stats["latency_max_seconds"] = max(latencies) if latencies else None
+        stats["batch_p50_seconds"] = percentile(batch_seconds, 0.5)
+        stats["batch_p95_seconds"] = percentile(batch_seconds, 0.95)
+        return stats
+
+
+toxicity_batcher = ToxicityBatcher()
+
+
+async def toxicity_scores_async(texts: List[str]) -> List[float]:
+    # Inference runs on the batcher's thread, keeping the event loop free, batched with other callers' texts
+    if not texts:
+        return []
+    futures = toxicity_batcher.submit(texts)
+    return list(await asyncio.gather(*[asyncio.wrap_future(future) for future in futures]))
@@ -1,12 +1,29 @@
+import asyncio
+import atexit
 import datetime
 import json
 import uuid
-from time import time, sleep
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from threading import Lock, Thread
+from time import time
 from os import environ as env
 from typing import Any, Dict, Union
 from data import log_to_jsonl
-import requests
-from huggingface_hub import hf_hub_download
+import http_pool
+from response_cache import RESPONSE_CACHE, cache_key, response_cache
+from rate_limit import RateLimitedError, check_rate_limit, estimate_tokens, get_limiter
+import runpod_client
+from endpoint_pool import EndpointError, EndpointPool
+from llm_scheduler import Scheduler
+from router import LLM_FALLBACK_WORKERS, InvalidOutputError, router
+from streaming_json import StreamingJSONParser, notify_partial_output, partial_output_listener
+import call_metrics
+from toxicity import CALM_THRESHOLD, load_toxicity_model
+from local_judge import LOCAL_JUDGE, load_similarity_model
+from promptObjects import GenerationBudget, prompt_templates, schema_generation_budget, template_prefix
 
 
 # There are 4 ways to use a LLM model currently used:
@@ -22,82 +39,179 @@ from huggingface_hub import hf_hub_download
 # See serverless.md for more information.
 # 4. Use the Mistral API, which is a paid services.
 
+# Nothing is downloaded or loaded when this module is imported.
+# Workers are registered at the end of this file, and initialised on first use, or by calling warmup().
+
 URL = "http://localhost:5834/v1/chat/completions"
+# The http worker can balance requests across several llama.cpp servers, given as a comma separated list:
+LLM_HTTP_URLS = [url.strip() for url in env.get("LLM_HTTP_URLS", URL).split(",") if url.strip()]
 in_memory_llm = None
-worker_options = ["runpod", "http", "in_memory", "mistral", "anthropic"]
 
 LLM_WORKER = env.get("LLM_WORKER", "anthropic")
-if LLM_WORKER not in worker_options:
-    raise ValueError(f"Invalid worker: {LLM_WORKER}")
 N_GPU_LAYERS = int(env.get("N_GPU_LAYERS", -1)) # Default to -1, use all layers if available
 CONTEXT_SIZE = int(env.get("CONTEXT_SIZE", 2048))
 LLM_MODEL_PATH = env.get("LLM_MODEL_PATH", None)
 
 MAX_TOKENS = int(env.get("MAX_TOKENS", 1000))
 TEMPERATURE = float(env.get("TEMPERATURE", 0.3))
-
-performing_local_inference = (LLM_WORKER == "in_memory" or (LLM_WORKER == "http" and "localhost" in URL))
-
-if LLM_MODEL_PATH and len(LLM_MODEL_PATH) > 0:
-    print(f"Using local model from {LLM_MODEL_PATH}")
-if performing_local_inference and not LLM_MODEL_PATH:
+# Print streamed tokens to stdout as they arrive, useful when developing
+PRINT_STREAM = env.get("PRINT_STREAM", "false").lower() == "true"
+# Reuse the in memory model's evaluated state for the static start of each prompt template:
+PREFIX_CACHE = env.get("PREFIX_CACHE", "true").lower() == "true"
+# Each saved state holds a copy of the KV cache and logits, which can be hundreds of MB, so only this many are kept:
+PREFIX_CACHE_ITEMS = int(env.get("PREFIX_CACHE_ITEMS", 5))
+MISTRAL_MODEL = "mistral-small-latest"
+ANTHROPIC_MODEL = "claude-3-opus-20240229"
+
+in_memory_llm_load_lock = Lock()
+
+
+def get_model_path():
+    global LLM_MODEL_PATH
+    if LLM_MODEL_PATH and len(LLM_MODEL_PATH) > 0:
+        print(f"Using local model from {LLM_MODEL_PATH}")
+        return LLM_MODEL_PATH
     print("No local LLM_MODEL_PATH environment variable set. We need a model, downloading model from HuggingFace Hub")
+    from huggingface_hub import hf_hub_download
     LLM_MODEL_PATH =hf_hub_download(
         repo_id=env.get("REPO_ID", "TheBloke/Mixtral-8x7B-Instruct-v0.1-GGUF"),
         filename=env.get("MODEL_FILE", "mixtral-8x7b-instruct-v0.1.Q4_K_M.gguf"),
     )
     print(f"Model downloaded to {LLM_MODEL_PATH}")
-if LLM_WORKER == "http" or LLM_WORKER == "in_memory":
-    from llama_cpp import Llama, LlamaGrammar, json_schema_to_gbnf
-
-if in_memory_llm is None and LLM_WORKER == "in_memory":
-    print("Loading model into memory. If you didn't want this, set the USE_HTTP_SERVER environment variable to 'true'.")
-    in_memory_llm = Llama(model_path=LLM_MODEL_PATH, n_ctx=CONTEXT_SIZE, n_gpu_layers=N_GPU_LAYERS, verbose=True)
-
-def llm_streaming(
-    prompt: str, pydantic_model_class, return_pydantic_object=False
-) -> Union[str, Dict[str, Any]]:
+    return LLM_MODEL_PATH
+
+
+def load_in_memory_llm():
+    global in_memory_llm
+    with in_memory_llm_load_lock:
+        if in_memory_llm is None:
+            from llama_cpp import Llama
+            model_path = get_model_path()
+            print("Loading model into memory. If you didn't want this, set the LLM_WORKER environment variable to another worker.")
+            in_memory_llm = Llama(model_path=model_path, n_ctx=CONTEXT_SIZE, n_gpu_layers=N_GPU_LAYERS, verbose=True)
+    return in_memory_llm
+
+# Grammar construction is repeated work, there are only a few model classes, and RunPod jobs
+# send the same schema strings over and over, so schemas and grammars are cached.
+# The cache keys are the model class or the JSON schema string.
+@lru_cache(maxsize=None)
+def pydantic_model_to_json_schema(pydantic_model_class) -> str:
     schema = pydantic_model_class.model_json_schema()
 
     # Optional example field from schema, is not needed for the grammar generation
     if "example" in schema:
         del schema["example"]
 
-    json_schema = json.dumps(schema)
-    grammar = json_schema_to_gbnf(json_schema)
+    return json.dumps(schema)
+
+
+@lru_cache(maxsize=128)
+def get_gbnf_grammar(json_schema: str) -> str:
+    from llama_cpp import json_schema_to_gbnf
+    return json_schema_to_gbnf(json_schema)
+
+
+@lru_cache(maxsize=128)
+def get_llama_grammar(json_schema: str):
+    # LlamaGrammar is reset by llama_cpp at the start of each generation, so it can be reused
+    from llama_cpp import LlamaGrammar
+    return LlamaGrammar.from_json_schema(json_schema)
+
+
+def compile_grammars(pydantic_model_classes=None, worker=None):
+    """Compiles grammars ahead of time, so the first requests don't pay for it."""
+    worker = worker or LLM_WORKER
+    if pydantic_model_classes is None:
+        from promptObjects import ImprovedText, Critique, FaithfulnessScore, SpicyScore, Judgement
+        pydantic_model_classes = [ImprovedText, Critique, FaithfulnessScore, SpicyScore, Judgement]
+    start_time = time()
+    for pydantic_model_class in pydantic_model_classes:
+        json_schema = pydantic_model_to_json_schema(pydantic_model_class)
+        if worker == "http":
+            get_gbnf_grammar(json_schema)
+        if worker == "in_memory":
+            get_llama_grammar(json_schema)
+    print(f"Compiled {len(pydantic_model_classes)} grammars in {time() - start_time:.3f} seconds")
+
+
+@lru_cache(maxsize=128)
+def get_schema_budget(json_schema: str) -> GenerationBudget:
+    # The schema's generation budget, with the MAX_TOKENS and TEMPERATURE defaults filled in
+    budget = schema_generation_budget(json_schema)
+    return GenerationBudget(
+        max_tokens=budget.max_tokens or MAX_TOKENS,
+        stop=budget.stop,
+        temperature=budget.temperature if budget.temperature is not None else TEMPERATURE,
+    )
+
+
+# A temperature for the calls made in the current context, overriding the budget's, e.g: for varied samples
+sampling_temperature = ContextVar("sampling_temperature", default=None)
 
-    payload = {
+
+@contextmanager
+def sampling_at(temperature):
+    """Use as "with sampling_at(0.9):" around LLM calls to sample them at that temperature, None keeps the default."""
+    token = sampling_temperature.set(temperature)
+    try:
+        yield
+    finally:
+        sampling_temperature.reset(token)
+
+
+def with_sampling_temperature(budget: GenerationBudget) -> GenerationBudget:
+    temperature = sampling_temperature.get()
+    return budget if temperature is None else budget.model_copy(update={"temperature": temperature})
+
+
+def get_generation_budget(pydantic_model_class) -> GenerationBudget:
+    if pydantic_model_class is None:
+        return with_sampling_temperature(GenerationBudget(max_tokens=MAX_TOKENS, temperature=TEMPERATURE))
+    return with_sampling_temperature(get_schema_budget(pydantic_model_to_json_schema(pydantic_model_class)))
+
+
+def restore_stop_sequence(output: str, budget: GenerationBudget) -> str:
+    # APIs leave the matched stop sequence out of the output, but the JSON needs its closing brace
+    if output is not None and "}" in budget.stop and not output.rstrip().endswith("}"):
+        return output + "}"
+    return output
+
+
+def http_payload(prompt: str, pydantic_model_class) -> dict:
+    # The grammar already ends generation with the JSON object, so stop sequences are not needed
+    grammar = get_gbnf_grammar(pydantic_model_to_json_schema(pydantic_model_class))
+    budget = get_generation_budget(pydantic_model_class)
+    return {
         "stream": True,
-        "max_tokens": MAX_TOKENS,
+        "max_tokens": budget.max_tokens,
         "grammar": grammar,
-        "temperature": TEMPERATURE,
+        "temperature": budget.temperature,
         "messages": [{"role": "user", "content": prompt}],
     }
-    headers = {
-        "Content-Type": "application/json",
-    }
 
-    response = requests.post(
-        URL,
-        headers=headers,
-        json=payload,
-        stream=True,
-    )
-    output_text = ""
-    for chunk in response.iter_lines():
-        if chunk:
-            chunk = chunk.decode("utf-8")
-            if chunk.startswith("data: "):
-                chunk = chunk.split("data: ")[1]
-                if chunk.strip() == "[DONE]":
-                    break
-                chunk = json.loads(chunk)
-                new_token = chunk.get("choices")[0].get("delta").get("content")
-                if new_token:
-                    output_text = output_text + new_token
-                    print(new_token, sep="", end="", flush=True)
-    print('\n')
 
+def parse_sse_line(line: str):
+    # Returns the new token from a server sent event line, "" if there is none, or None when the stream is done
+    if not line.startswith("data: "):
+        return ""
+    line = line.split("data: ")[1]
+    if line.strip() == "[DONE]":
+        return None
+    chunk = json.loads(line)
+    return chunk.get("choices")[0].get("delta").get("content") or ""
+
+
+def read_stream_token(parser, new_token) -> bool:
+    # Feeds a streamed token to the parser, returns True once the JSON object is complete so the stream can be stopped
+    if PRINT_STREAM:
+        print(new_token, sep="", end="", flush=True)
+    call_metrics.record_tokens(1)
+    complete = parser.feed(new_token)
+    notify_partial_output(parser)
+    return complete
+
+
+def parse_output(output_text: str, pydantic_model_class, return_pydantic_object=False):
     if return_pydantic_object:
         model_object = pydantic_model_class.model_validate_json(output_text)
         return model_object
@@ -106,6 +220,96 @@ def llm_streaming(
         return json_output
 
 
+def check_endpoint_status(endpoint, status_code):
+    if status_code >= 500:
+        raise EndpointError(f"Endpoint {endpoint.url} returned status code: {status_code}")
+
+
+def should_fail_over(error, parser, attempt, attempts) -> bool:
+    # A request can only be moved to another endpoint if none of its output has been used yet
+    if isinstance(error, RateLimitedError) or parser.started:
+        return False
+    return attempt < attempts - 1
+
+
+def llm_streaming(
+    prompt: str, pydantic_model_class, return_pydantic_object=False
+) -> Union[str, Dict[str, Any]]:
+    payload = http_payload(prompt, pydantic_model_class)
+    headers = {
+        "Content-Type": "application/json",
+    }
+
+    attempts = http_endpoints.failover_attempts()
+    tried = set()  # Each retry goes to an endpoint this request hasn't failed on yet
+    for attempt in range(attempts):
+        parser = StreamingJSONParser()
+        try:
+            # Closing the response stops generation on the server once the JSON object is complete
+            with get_limiter("http").limit(), http_endpoints.use(tried) as endpoint:
+                tried.add(endpoint)
+                with http_pool.post(
+                    endpoint.url,
+                    headers=headers,
+                    json=payload,
+                    stream=True,
+                ) as response:
+                    check_rate_limit("http", response.status_code, response.headers.get("Retry-After"), "")
+                    check_endpoint_status(endpoint, response.status_code)
+                    for chunk in response.iter_lines():
+                        if chunk:
+                            new_token = parse_sse_line(chunk.decode("utf-8"))
+                            if new_token is None:
+                                break
+                            if new_token and read_stream_token(parser, new_token):
+                                break
+            break
+        except Exception as e:
+            if not should_fail_over(e, parser, attempt, attempts):
+                raise
+            print(f"Retrying on another endpoint after: {e}")
+
+    return parse_output(parser.text(), pydantic_model_class, return_pydantic_object)
+
+
+async def llm_streaming_async(
+    prompt: str, pydantic_model_class, return_pydantic_object=False
+) -> Union[str, Dict[str, Any]]:
+    payload = http_payload(prompt, pydantic_model_class)
+    headers = {
+        "Content-Type": "application/json",
+    }
+
+    attempts = http_endpoints.failover_attempts()
+    tried = set()  # Each retry goes to an endpoint this request hasn't failed on yet
+    for attempt in range(attempts):
+        parser = StreamingJSONParser()
+        try:
+            async with get_limiter("http").limit_async():
+                with http_endpoints.use(tried) as endpoint:
+                    tried.add(endpoint)
+                    async with http_pool.async_post(endpoint.url, headers=headers, json=payload) as response:
+                        check_rate_limit("http", response.status, response.headers.get("Retry-After"), "")
+                        check_endpoint_status(endpoint, response.status)
+                        async for chunk in response.content:
+                            chunk = chunk.decode("utf-8").strip()
+                            if chunk:
+                                new_token = parse_sse_line(chunk)
+                                if new_token is None:
+                                    break
+                                if new_token and read_stream_token(parser, new_token):
+                                    # Leaving early closes the connection, so the server stops generating
+                                    response.close()
+                                    break
+            break
+        except Exception as e:
+            if not should_fail_over(e, parser, attempt, attempts):
+                raise
+            print(f"Retrying on another endpoint after: {e}")
+
+    return parse_output(parser.text(), pydantic_model_class, return_pydantic_object)
+
+
 def replace_text(template: str, replacements: dict) -> str:
     for key, value in replacements.items():
         template = template.replace(f"{{{key}}}", value)
@@ -123,84 +327,150 @@ def calculate_overall_score(faithfulness, spiciness):
 def llm_stream_sans_network(
     prompt: str, pydantic_model_class, return_pydantic_object=False
 ) -> Union[str, Dict[str, Any]]:
-    schema = pydantic_model_class.model_json_schema()
-
-    # Optional example field from schema, is not needed for the grammar generation
-    if "example" in schema:
-        del schema["example"]
-
-    json_schema = json.dumps(schema)
-    grammar = LlamaGrammar.from_json_schema(json_schema)
-
-    stream = in_memory_llm(
-        prompt,
-        max_tokens=MAX_TOKENS,
-        temperature=TEMPERATURE,
-        grammar=grammar,
-        stream=True
-    )
-
-    output_text = ""
-    for chunk in stream:
-        result = chunk["choices"][0]
-        print(result["text"], end='', flush=True)
-        output_text = output_text + result["text"]
+    output_text = llm_stream_sans_network_simple(prompt, pydantic_model_to_json_schema(pydantic_model_class))
+    return parse_output(output_text, pydantic_model_class, return_pydantic_object)
 
-    print('\n')
 
-    if return_pydantic_object:
-        model_object = pydantic_model_class.model_validate_json(output_text)
-        return model_object
+async def llm_stream_sans_network_async(
+    prompt: str, pydantic_model_class, return_pydantic_object=False
+) -> Union[str, Dict[str, Any]]:
+    # Inference runs on the scheduler's thread, keeping the event loop free for network workers.
+    # Cancelling the awaiting task drops the job if it hasn't started yet.
+    json_schema = pydantic_model_to_json_schema(pydantic_model_class)
+    key = in_memory_job_key(prompt, json_schema)
+    future = in_memory_scheduler.submit(lambda: generate_in_memory(prompt, json_schema), key=key)
+    output_text = await asyncio.wrap_future(future)
+    return parse_output(output_text, pydantic_model_class, return_pydantic_object)
+
+
+# The in memory model can only run one generation at a time. Gradio, the RunPod handler and batch jobs
+# can all call it at once, so its generations are queued on one scheduler thread, interactive calls first.
+# Use llm_scheduler.scheduling_priority("batch") around calls that can wait, and see in_memory_scheduler.get_stats().
+in_memory_scheduler = Scheduler("in_memory")
+in_memory_lock = Lock()
+
+# Evaluating the prompt is most of the in memory worker's time on a CPU, and each template starts with
+# the same long instructions, so the model state after each template's static prefix is saved once,
+# then loaded before each call, leaving llama_cpp to evaluate only the tokens after the prefix.
+# Longest first, so a prefix that starts with another prefix is matched before it.
+prompt_prefixes = sorted({template_prefix(template) for template in prompt_templates}, key=len, reverse=True)
+prefix_states = OrderedDict()  # Prefix -> LlamaState after evaluating it, least recently used first
+
+
+def load_prefix_state(llm, prompt):
+    # Caller holds in_memory_lock
+    if not PREFIX_CACHE:
+        return
+    prefix = next((prefix for prefix in prompt_prefixes if prompt.startswith(prefix)), None)
+    if prefix is None:
+        return
+    state = prefix_states.get(prefix)
+    if state is None:
+        # Evaluated through a completion, so it's tokenised the same way as the full prompt will be.
+        # The one generated token is not part of the prompt, so it is not reused.
+        llm.reset()
+        llm(prefix, max_tokens=1, temperature=0)
+        state = prefix_states[prefix] = llm.save_state()
+        print(f"Saved prefix state of {state.n_tokens} tokens")
+        while len(prefix_states) > PREFIX_CACHE_ITEMS:
+            prefix_states.popitem(last=False)
     else:
-        json_output = json.loads(output_text)
-        return json_output
-
-
-def llm_stream_serverless(prompt,model):
-    RUNPOD_ENDPOINT_ID = env.get("RUNPOD_ENDPOINT_ID")
-    RUNPOD_API_KEY = env.get("RUNPOD_API_KEY")
-    assert RUNPOD_ENDPOINT_ID, "RUNPOD_ENDPOINT_ID environment variable not set"
-    assert RUNPOD_API_KEY, "RUNPOD_API_KEY environment variable not set"
-    url = f"https://api.runpod.ai/v2/{RUNPOD_ENDPOINT_ID}/runsync"
-
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {RUNPOD_API_KEY}'
-    }
-    
+        llm.load_state(state)
+        prefix_states.move_to_end(prefix)
+
+
+def warm_prefix_cache():
+    llm = load_in_memory_llm()
+    start_time = time()
+    with in_memory_lock:
+        for prefix in prompt_prefixes[:PREFIX_CACHE_ITEMS]:
+            load_prefix_state(llm, prefix)
+    print(f"Evaluated {len(prefix_states)} prompt prefixes in {time() - start_time:.3f} seconds")
+
+
+def llm_stream_sans_network_simple(prompt: str, json_schema: str) -> str:
+    # Used by the RunPod handler, which gets the schema as a JSON string rather than a model class.
+    # Identical queued calls are coalesced, and generated once.
+    key = in_memory_job_key(prompt, json_schema)
+    return in_memory_scheduler.run(lambda: generate_in_memory(prompt, json_schema), key=key)
+
+
+def in_memory_job_key(prompt: str, json_schema: str):
+    # A coalesced job runs in its first caller's context, so calls only share one if that context fits them all:
+    # the same sampling temperature and deadline, a deadline would otherwise cut the output short for the others.
+    # A partial output listener belongs to one caller, so those calls aren't coalesced.
+    if partial_output_listener.get() is not None:
+        return None
+    return prompt, json_schema, sampling_temperature.get(), call_deadline.get()
+
+
+def generate_in_memory(prompt: str, json_schema: str) -> str:
+    # Runs on the in memory scheduler's thread
+    grammar = get_llama_grammar(json_schema)
+    budget = with_sampling_temperature(get_schema_budget(json_schema))
+    llm = load_in_memory_llm()
+
+    with in_memory_lock:
+        load_prefix_state(llm, prompt)
+        stream = llm(
+            prompt,
+            max_tokens=budget.max_tokens,
+            temperature=budget.temperature,
+            grammar=grammar,
+            stream=True
+        )
+
+        parser = StreamingJSONParser()
+        deadline = call_deadline.get()
+        for chunk in stream:
+            result = chunk["choices"][0]
+            if read_stream_token(parser, result["text"]):
+                break
+            if deadline is not None and time() > deadline:
+                # The caller has given up waiting, so stop rather than hold the model for a discarded answer
+                print("In memory generation stopped at the call's deadline")
+                break
+        # Closing the generator stops llama_cpp generating any more tokens
+        stream.close()
+
+    return parser.text()
+
+
+def runpod_job_input(prompt, model):
     schema = model.schema()
-    data = {
-        'input': {
-            'schema': json.dumps(schema),
-            'prompt': prompt
-        }
+    job_input = {
+        'schema': json.dumps(schema),
+        'prompt': prompt
     }
-    
-    response = requests.post(url, json=data, headers=headers)
-    assert response.status_code == 200, f"Unexpected RunPod API status code: {response.status_code} with body: {response.text}"
-    result = response.json()
+    if sampling_temperature.get() is not None:
+        job_input['temperature'] = sampling_temperature.get()
+    return job_input
+
+
+def runpod_output(result):
     print(result)
-    # TODO: After a 30 second timeout, a job ID is returned in the response instead,
-    # and the client must poll the job status endpoint to get the result.
     output = result['output'].replace("model:mixtral-8x7b-instruct-v0.1.Q4_K_M.gguf\n", "")
+    # RunPod doesn't report usage, so tokens are estimated at roughly 4 characters per token
+    call_metrics.record_tokens(len(output) // 4)
     # TODO: remove replacement once new version of runpod is deployed
     return json.loads(output)
 
-# Global variables to enforce rate limiting
-LAST_REQUEST_TIME = None
-REQUEST_INTERVAL = 0.5  # Minimum time interval between requests in seconds
-
-def llm_stream_mistral_api(prompt: str, pydantic_model_class=None, attempts=0) -> Union[str, Dict[str, Any]]:
-    global LAST_REQUEST_TIME
-    current_time = time()
-    if LAST_REQUEST_TIME is not None:
-        elapsed_time = current_time - LAST_REQUEST_TIME
-        if elapsed_time < REQUEST_INTERVAL:
-            sleep_time = REQUEST_INTERVAL - elapsed_time
-            sleep(sleep_time)
-            print(f"Slept for {sleep_time} seconds to enforce rate limit")
-    LAST_REQUEST_TIME = time()
 
+def llm_stream_serverless(prompt,model):
+    # Jobs are submitted with /run and polled, so long or queued jobs don't time out like /runsync
+    with get_limiter("runpod").limit():
+        result = runpod_client.run_job(runpod_job_input(prompt, model))
+    return runpod_output(result)
+
+
+async def llm_stream_serverless_async(prompt, model):
+    # Polling awaits between status checks, so many jobs can be in flight without holding threads
+    async with get_limiter("runpod").limit_async():
+        result = await runpod_client.run_job_async(runpod_job_input(prompt, model))
+    return runpod_output(result)
+
+
+def mistral_request(prompt: str, budget: GenerationBudget):
     MISTRAL_API_URL = env.get("MISTRAL_API_URL", "https://api.mistral.ai/v1/chat/completions")
     MISTRAL_API_KEY = env.get("MISTRAL_API_KEY", None)
     if not MISTRAL_API_KEY:
@@ -211,7 +481,9 @@ def llm_stream_mistral_api(prompt: str, pydantic_model_class=None, attempts=0) -
         'Authorization': f'Bearer {MISTRAL_API_KEY}'
     }
     data = {
-        'model': 'mistral-small-latest',
+        'model': MISTRAL_MODEL,
+        'max_tokens': budget.max_tokens,
+        'temperature': budget.temperature,
         'messages': [
             {
                 'role': 'user',
@@ -220,41 +492,76 @@ def llm_stream_mistral_api(prompt: str, pydantic_model_class=None, attempts=0) -
             }
         ]
     }
-    response = requests.post(MISTRAL_API_URL, headers=headers, json=data)
+    if budget.stop:
+        data['stop'] = budget.stop
+    return MISTRAL_API_URL, headers, data
+
+
+def mistral_output_is_valid(output: str, pydantic_model_class) -> bool:
+    if not pydantic_model_class:
+        print("No pydantic model class provided, returning without class validation")
+        return True
+    # TODO: Use more robust error handling that works for all cases without retrying?
+    # Maybe APIs that dont have grammar should be avoided?
+    # Investigate grammar enforcement with open ended generations?
+    try:
+        parsed_result = pydantic_model_class.model_validate_json(output)
+        print(parsed_result)
+        # This will raise an exception if the model is invalid,
+        return True
+    except Exception as e:
+        print(f"Error validating pydantic model: {e}")
+        return False
+
+
+def llm_stream_mistral_api(prompt: str, pydantic_model_class=None) -> Union[str, Dict[str, Any]]:
+    budget = get_generation_budget(pydantic_model_class)
+    url, headers, data = mistral_request(prompt, budget)
+    limiter = get_limiter("mistral")
+    estimated_tokens = estimate_tokens(prompt, budget.max_tokens)
+    with limiter.limit(estimated_tokens):
+        response = http_pool.post(url, headers=headers, json=data)
+    check_rate_limit("mistral", response.status_code, response.headers.get("Retry-After"), response.text)
     if response.status_code != 200:
         raise ValueError(f"Unexpected Mistral API status code: {response.status_code} with body: {response.text}")
     result = response.json()
+    limiter.report_usage(estimated_tokens, result.get("usage", {}).get("total_tokens"))
+    call_metrics.record_tokens(result.get("usage", {}).get("completion_tokens", 0))
     print(result)
-    output = result['choices'][0]['message']['content']
-    if pydantic_model_class:
-        # TODO: Use more robust error handling that works for all cases without retrying?
-        # Maybe APIs that dont have grammar should be avoided?
-        # Investigate grammar enforcement with open ended generations?
-        try:
-            parsed_result = pydantic_model_class.model_validate_json(output)
-            print(parsed_result)
-            # This will raise an exception if the model is invalid,
-        except Exception as e:
-            print(f"Error validating pydantic model: {e}")
-            # Let's retry by calling ourselves again if attempts < 3
-            if attempts == 0:
-                # We modify the prompt to remind it to output JSON in the required format
-                prompt = f"{prompt} You must output the JSON in the required format!"
-            if attempts < 3:
-                attempts += 1
-                print(f"Retrying Mistral API call, attempt {attempts}")
-                return llm_stream_mistral_api(prompt, pydantic_model_class, attempts)
+    output = restore_stop_sequence(result['choices'][0]['message']['content'], budget)
+    if not mistral_output_is_valid(output, pydantic_model_class):
+        # The router retries with backoff, reminding it to output JSON in the required format
+        raise InvalidOutputError(f"Mistral API output did not match {pydantic_model_class.__name__}: {output}")
+    return json.loads(output)
 
-    else:
-        print("No pydantic model class provided, returning without class validation")
+
+async def llm_stream_mistral_api_async(prompt: str, pydantic_model_class=None) -> Union[str, Dict[str, Any]]:
+    budget = get_generation_budget(pydantic_model_class)
+    url, headers, data = mistral_request(prompt, budget)
+    limiter = get_limiter("mistral")
+    estimated_tokens = estimate_tokens(prompt, budget.max_tokens)
+    async with limiter.limit_async(estimated_tokens), http_pool.async_post(url, headers=headers, json=data) as response:
+        body = await response.text()
+        check_rate_limit("mistral", response.status, response.headers.get("Retry-After"), body)
+        if response.status != 200:
+            raise ValueError(f"Unexpected Mistral API status code: {response.status} with body: {body}")
+    result = json.loads(body)
+    limiter.report_usage(estimated_tokens, result.get("usage", {}).get("total_tokens"))
+    call_metrics.record_tokens(result.get("usage", {}).get("completion_tokens", 0))
+    print(result)
+    output = restore_stop_sequence(result['choices'][0]['message']['content'], budget)
+    if not mistral_output_is_valid(output, pydantic_model_class):
+        # The router retries with backoff, reminding it to output JSON in the required format
+        raise InvalidOutputError(f"Mistral API output did not match {pydantic_model_class.__name__}: {output}")
     return json.loads(output)
 
 
-def send_anthropic_request(prompt: str):
+def anthropic_request(prompt: str, budget: GenerationBudget):
+    ANTHROPIC_API_URL = env.get("ANTHROPIC_API_URL", "https://api.anthropic.com/v1/messages")
     api_key = env.get("ANTHROPIC_API_KEY")
     if not api_key:
         print("API key not found. Please set the ANTHROPIC_API_KEY environment variable.")
-        return
+        return None, None, None
 
     headers = {
         'x-api-key': api_key,
@@ -263,66 +570,295 @@ def send_anthropic_request(prompt: str):
     }
 
     data = {
-        "model": "claude-3-opus-20240229",
-        "max_tokens": 1024,
+        "model": ANTHROPIC_MODEL,
+        "max_tokens": budget.max_tokens,
+        "temperature": budget.temperature,
         "messages": [{"role": "user", "content": prompt}]
     }
+    if budget.stop:
+        data["stop_sequences"] = budget.stop
+    return ANTHROPIC_API_URL, headers, data
+
+
+def anthropic_used_tokens(response_json):
+    usage = response_json.get("usage")
+    if not usage:
+        return None
+    return usage.get("input_tokens", 0) + usage.get("output_tokens", 0)
 
-    response = requests.post('https://api.anthropic.com/v1/messages', headers=headers, data=json.dumps(data))
+
+def send_anthropic_request(prompt: str, budget: GenerationBudget = None):
+    budget = budget or get_generation_budget(None)
+    url, headers, data = anthropic_request(prompt, budget)
+    if headers is None:
+        return
+
+    limiter = get_limiter("anthropic")
+    estimated_tokens = estimate_tokens(prompt, data["max_tokens"])
+    with limiter.limit(estimated_tokens):
+        response = http_pool.post(url, headers=headers, data=json.dumps(data))
+    check_rate_limit("anthropic", response.status_code, response.headers.get("Retry-After"), response.text)
     if response.status_code != 200:
         print(f"Unexpected Anthropic API status code: {response.status_code} with body: {response.text}")
         raise ValueError(f"Unexpected Anthropic API status code: {response.status_code} with body: {response.text}")
     j = response.json()
+    limiter.report_usage(estimated_tokens, anthropic_used_tokens(j))
+    call_metrics.record_tokens((j.get("usage") or {}).get("output_tokens", 0))
     
-    text = j['content'][0]["text"]
+    text = restore_stop_sequence(j['content'][0]["text"], budget)
     print(text)
     return text
 
-def llm_anthropic_api(prompt: str, pydantic_model_class=None, attempts=0) -> Union[str, Dict[str, Any]]:
+
+async def send_anthropic_request_async(prompt: str, budget: GenerationBudget = None):
+    budget = budget or get_generation_budget(None)
+    url, headers, data = anthropic_request(prompt, budget)
+    if headers is None:
+        return
+
+    limiter = get_limiter("anthropic")
+    estimated_tokens = estimate_tokens(prompt, data["max_tokens"])
+    async with limiter.limit_async(estimated_tokens), http_pool.async_post(url, headers=headers, data=json.dumps(data)) as response:
+        body = await response.text()
+        check_rate_limit("anthropic", response.status, response.headers.get("Retry-After"), body)
+        if response.status != 200:
+            print(f"Unexpected Anthropic API status code: {response.status} with body: {body}")
+            raise ValueError(f"Unexpected Anthropic API status code: {response.status} with body: {body}")
+    j = json.loads(body)
+    limiter.report_usage(estimated_tokens, anthropic_used_tokens(j))
+    call_metrics.record_tokens((j.get("usage") or {}).get("output_tokens", 0))
+
+    text = restore_stop_sequence(j['content'][0]["text"], budget)
+    print(text)
+    return text
+
+
+def anthropic_output_is_valid(output: str, pydantic_model_class) -> bool:
+    try:
+        parsed_result = pydantic_model_class.model_validate_json(output)
+        print(parsed_result)
+        # This will raise an exception if the model is invalid.
+        return True
+    except Exception as e:
+        print(f"Error validating pydantic model: {e}")
+        return False
+
+
+def llm_anthropic_api(prompt: str, pydantic_model_class=None) -> Union[str, Dict[str, Any]]:
     # With no streaming or rate limits, we use the Anthropic API, we have string input and output from send_anthropic_request,
     # but we need to convert it to JSON for the pydantic model class like the other APIs.
-    output = send_anthropic_request(prompt)
+    output = send_anthropic_request(prompt, get_generation_budget(pydantic_model_class))
+    return anthropic_output(output, pydantic_model_class)
+
+
+async def llm_anthropic_api_async(prompt: str, pydantic_model_class=None) -> Union[str, Dict[str, Any]]:
+    output = await send_anthropic_request_async(prompt, get_generation_budget(pydantic_model_class))
+    return anthropic_output(output, pydantic_model_class)
+
+
+def anthropic_output(output, pydantic_model_class):
     if pydantic_model_class:
-        try:
-            parsed_result = pydantic_model_class.model_validate_json(output)
-            print(parsed_result)
-            # This will raise an exception if the model is invalid.
+        if anthropic_output_is_valid(output, pydantic_model_class):
             return json.loads(output)
-        except Exception as e:
-            print(f"Error validating pydantic model: {e}")
-            # Let's retry by calling ourselves again if attempts < 3
-            if attempts == 0:
-                # We modify the prompt to remind it to output JSON in the required format
-                prompt = f"{prompt} You must output the JSON in the required format only, with no remarks or prefacing remarks - JUST JSON!"
-            if attempts < 3:
-                attempts += 1
-                print(f"Retrying Anthropic API call, attempt {attempts}")
-                return llm_anthropic_api(prompt, pydantic_model_class, attempts)
+        # The router retries with backoff, reminding it to output only JSON
+        raise InvalidOutputError(f"Anthropic API output did not match {pydantic_model_class.__name__}: {output}")
     else:
         print("No pydantic model class provided, returning without class validation")
         return json.loads(output)
 
-def query_ai_prompt(prompt, replacements, model_class):
-    prompt = replace_text(prompt, replacements)
-    if LLM_WORKER == "anthropic":
-        result = llm_anthropic_api(prompt, model_class)
-    if LLM_WORKER == "mistral":
-        result = llm_stream_mistral_api(prompt, model_class)
-    if LLM_WORKER == "runpod":
-        result = llm_stream_serverless(prompt, model_class)
-    if LLM_WORKER == "http":
-        result = llm_streaming(prompt, model_class)
-    if LLM_WORKER == "in_memory":
-        result = llm_stream_sans_network(prompt, model_class)
-    
+
+def log_prompt(prompt, result, worker_name):
     log_entry = {
         "uuid": str(uuid.uuid4()),
         "timestamp": datetime.datetime.utcnow().isoformat(),
-        "worker": LLM_WORKER,
+        "worker": worker_name,
         "prompt_input": prompt,
         "prompt_output": result
     }
     log_to_jsonl('prompt_inputs_and_outputs.jsonl', log_entry)
 
+
+class LLMWorker:
+    """A registered LLM worker, initialised once, lazily on first use or explicitly by warmup()."""
+
+    def __init__(self, name, call, call_async, init=None, model_name=None):
+        self.name = name
+        self.call = call
+        self.call_async = call_async
+        self.init = init
+        # Used in the response cache key, so cached outputs from one model are not returned for another
+        self.model_name = model_name or (lambda: name)
+        self.initialised = init is None
+        self.init_seconds = 0.0
+        self.lock = Lock()
+
+    def warmup(self):
+        if self.initialised:
+            return self
+        with self.lock:
+            if not self.initialised:
+                start_time = time()
+                self.init()
+                self.init_seconds = time() - start_time
+                self.initialised = True
+                print(f"Initialised {self.name} worker in {self.init_seconds:.3f} seconds")
+        return self
+
+
+workers = {}
+
+
+def register_worker(name, call, call_async, init=None, model_name=None):
+    workers[name] = LLMWorker(name, call, call_async, init, model_name)
+
+
+def get_worker(name=None) -> LLMWorker:
+    name = name or LLM_WORKER
+    if name not in workers:
+        raise ValueError(f"Invalid worker: {name}")
+    return workers[name].warmup()
+
+
+async def get_worker_async(name=None) -> LLMWorker:
+    worker = workers.get(name or LLM_WORKER)
+    if worker is not None and worker.initialised:
+        return worker
+    # Initialising can mean loading a model, so it is kept off the event loop
+    return await asyncio.to_thread(get_worker, name)
+
+
+def warmup(name=None):
+    """Initialises a worker (by default LLM_WORKER) now rather than on first use, and returns start-up timings."""
+    worker = get_worker(name)
+    if CALM_THRESHOLD or LOCAL_JUDGE:
+        load_toxicity_model()  # Scores input, to skip the LLM for calm text, and edits for the local judge
+    if LOCAL_JUDGE:
+        load_similarity_model()
+    call_metrics.start_metrics_server()
+    return {"worker": worker.name, "init_seconds": worker.init_seconds}
+
+
+def route_candidates(worker):
+    # The chosen worker, then the fallbacks, which are initialised by the router if they get used
+    return [worker] + [workers[name] for name in LLM_FALLBACK_WORKERS if name != worker.name]
+
+
+def model_class_name(model_class):
+    return model_class.__name__ if model_class else None
+
+
+def worker_cache_key(worker, prompt, model_class):
+    json_schema = pydantic_model_to_json_schema(model_class) if model_class else None
+    temperature = get_generation_budget(model_class).temperature
+    return cache_key(worker.name, worker.model_name(), temperature, prompt, model_class_name(model_class), json_schema)
+
+
+# The time the current LLM call must finish by, set by query_ai_prompt_async's deadline argument.
+# Cancelling the call stops network requests, a running in memory generation checks it to stop early.
+call_deadline = ContextVar("call_deadline", default=None)
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    """A call was cut off at the deadline its caller gave it, rather than timing out itself."""
+    pass
+
+
+def query_ai_prompt(prompt, replacements, model_class, use_cache=True, stage=None):
+    # Synchronous wrapper around query_ai_prompt_async, see it for the arguments
+    return run_sync(query_ai_prompt_async(prompt, replacements, model_class, use_cache, stage))
+
+
+async def query_ai_prompt_async(prompt, replacements, model_class, use_cache=True, stage=None, deadline=None):
+    # deadline is a time() by which the call must finish, after it the call (with its retries, hedges,
+    # queueing and streaming) is cancelled, and DeadlineExceeded is raised
+    if deadline is not None:
+        name = stage or model_class_name(model_class)
+        remaining = deadline - time()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"No time left for the {name} call")
+        token = call_deadline.set(deadline)
+        # Started after setting the deadline, so the call's task has it in its context
+        task = asyncio.ensure_future(query_ai_prompt_async(prompt, replacements, model_class, use_cache, stage))
+        try:
+            done, _ = await asyncio.wait({task}, timeout=remaining)
+            if not done:
+                task.cancel()
+                await asyncio.wait({task})  # Lets the call clean up, e.g: record its timing
+                raise DeadlineExceeded(f"The {name} call was cut off at its deadline")
+            # Errors of the call itself, including its own timeouts, are raised as they are
+            return task.result()
+        finally:
+            task.cancel()
+            call_deadline.reset(token)
+
+    prompt = replace_text(prompt, replacements)
+    worker = await get_worker_async()
+    use_cache = use_cache and RESPONSE_CACHE
+    with call_metrics.time_call(stage or model_class_name(model_class), model_class_name(model_class), prompt) as timer:
+        timer.worker = worker.name
+        if use_cache:
+            cached_result = await response_cache.get_async(worker_cache_key(worker, prompt, model_class))
+            if cached_result is not None:
+                timer.cached = True
+                return cached_result
+        # A slow call is hedged with a fallback worker, the answer from either is used
+        result, worker = await router.call_async(route_candidates(worker), prompt, model_class)
+        timer.worker = worker.name
+
+    log_prompt(prompt, result, worker.name)
+    if use_cache:
+        await response_cache.set_async(worker_cache_key(worker, prompt, model_class), result)
     return result
 
+
+# The sync API runs coroutines on one long lived background event loop, so the async HTTP
+# sessions (and their keep-alive connections) are reused between calls.
+_background_loop = None
+_background_loop_lock = Lock()
+
+def get_background_loop():
+    global _background_loop
+    with _background_loop_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            Thread(target=_background_loop.run_forever, name="chill-event-loop", daemon=True).start()
+    return _background_loop
+
+
+def run_sync(coroutine):
+    """Runs a coroutine to completion from synchronous code and returns its result."""
+    return asyncio.run_coroutine_threadsafe(coroutine, get_background_loop()).result()
+
+
+@atexit.register
+def close_background_loop_session():
+    if _background_loop is not None and _background_loop.is_running():
+        asyncio.run_coroutine_threadsafe(http_pool.close_async_session(), _background_loop).result(timeout=5)
+
+
+http_endpoints = EndpointPool(LLM_HTTP_URLS)
+
+
+def init_http_worker():
+    if any("localhost" in url for url in LLM_HTTP_URLS):
+        # A local llama.cpp server needs a model file, so make sure it's been downloaded
+        get_model_path()
+    compile_grammars(worker="http")
+    if len(LLM_HTTP_URLS) > 1:
+        print(f"Endpoint health: {http_endpoints.check_health()}")
+        http_endpoints.start_health_checks()
+
+
+def init_in_memory_worker():
+    load_in_memory_llm()
+    compile_grammars(worker="in_memory")
+    if PREFIX_CACHE:
+        warm_prefix_cache()
+
+
+register_worker("anthropic", llm_anthropic_api, llm_anthropic_api_async, model_name=lambda: ANTHROPIC_MODEL)
+register_worker("mistral", llm_stream_mistral_api, llm_stream_mistral_api_async, model_name=lambda: MISTRAL_MODEL)
+register_worker("runpod", llm_stream_serverless, llm_stream_serverless_async, model_name=lambda: env.get("RUNPOD_ENDPOINT_ID"))
+register_worker("http", llm_streaming, llm_streaming_async, init=init_http_worker, model_name=lambda: ",".join(LLM_HTTP_URLS))
+register_worker("in_memory", llm_stream_sans_network, llm_stream_sans_network_async, init=init_in_memory_worker, model_name=lambda: LLM_MODEL_PATH)
+worker_options = list(workers)